@@ -1,3 +1,5 @@
+from . import instrument
+from . import backend
 from . import utils
 from . import census
 from . import oa_boundary
@@ -5,3 +7,6 @@ from . import osm
 
 from . import database
 from . import election
+from . import prefetch
+from . import rollup
+from . import census_matrix
@@ -0,0 +1,479 @@
+"""
+The database operations used by `fynesse.access`, for each supported database.
+Functions in `fynesse.access` take a `conn` and use `get_backend(conn)` for
+anything that isn't portable SQL, so a pymysql connection to MariaDB and an
+embedded sqlite3 connection (see `create_embedded_connection`) can be used
+interchangeably.
+"""
+
+import csv
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+
+import pandas as pd
+
+from fynesse.access.instrument import InstrumentedSQLiteConnection, echo
+
+
+class Backend(ABC):
+    """
+    Operations shared by every database. Subclasses must implement the
+    abstract methods, so an incomplete backend fails when it is created.
+    """
+
+    # Placeholder for query parameters
+    param = "%s"
+    # Appended to every CREATE TABLE statement
+    table_options = ""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, statement: str, args=None) -> int:
+        echo(statement)
+        cur = self.conn.cursor()
+        cur.execute(statement, *([] if args is None else [args]))
+        rows = cur.rowcount
+        cur.close()
+        self.conn.commit()
+        return rows
+
+    def query(self, statement: str, args=None) -> list[tuple]:
+        cur = self.conn.cursor()
+        cur.execute(statement, *([] if args is None else [args]))
+        rows = cur.fetchall()
+        cur.close()
+        return list(rows)
+
+    def read_sql(self, statement: str) -> pd.DataFrame:
+        return pd.read_sql(statement, self.conn)
+
+    def count(self, table: str, where: str | None = None) -> int:
+        statement = f"SELECT count(*) FROM `{table}`"
+        if where:
+            statement = f"{statement} WHERE {where}"
+        return self.query(statement)[0][0]
+
+    def column_type(self, rem: str) -> str:
+        return rem
+
+    def create_table(
+        self,
+        name: str,
+        columns: list[tuple[str, str]],
+        primary_key: str | None = None,
+        drop: bool = False,
+    ):
+        if drop:
+            self.execute(f"DROP TABLE IF EXISTS `{name}`")
+
+        lines = [f"`{key}` {self.column_type(rem)}" for key, rem in columns]
+        if primary_key is not None:
+            lines.append(self.auto_increment_primary_key(primary_key))
+
+        statement = "\n".join(
+            [
+                f"CREATE TABLE IF NOT EXISTS `{name}` (",
+                ",\n".join(lines),
+                f"){self.table_options};",
+            ]
+        )
+        self.execute(statement)
+
+    def create_temporary_table(self, name: str, columns: list[tuple[str, str]]):
+        self.drop_temporary_table(name)
+        lines = ",\n".join(f"`{key}` {self.column_type(rem)}" for key, rem in columns)
+        self.execute(f"CREATE TEMPORARY TABLE `{name}` (\n{lines}\n)")
+
+    def executemany(self, statement: str, rows: list[tuple]):
+        cur = self.conn.cursor()
+        cur.executemany(statement, rows)
+        cur.close()
+
+    @abstractmethod
+    def table_exists(self, table: str) -> bool:
+        ...
+
+    @abstractmethod
+    def column_exists(self, table: str, column: str) -> bool:
+        ...
+
+    @abstractmethod
+    def index_exists(self, table: str, index: str) -> bool:
+        ...
+
+    @abstractmethod
+    def table_versions(self, tables: list[str]) -> list:
+        ...
+
+    @abstractmethod
+    def auto_increment_primary_key(self, name: str) -> str:
+        ...
+
+    @abstractmethod
+    def drop_temporary_table(self, name: str):
+        ...
+
+    @abstractmethod
+    def add_index(self, table: str, columns: list[str], name: str | None = None):
+        ...
+
+    @abstractmethod
+    def add_primary_key(self, table: str, field: str):
+        ...
+
+    @abstractmethod
+    def add_row_ids(self, table: str, name: str):
+        """
+        Numbers the rows of `table` in a new AUTO_INCREMENT primary key
+        column `name`, or numbers the rows appended since if it exists.
+        """
+
+    @abstractmethod
+    def modify_columns(self, table: str, columns: list[tuple[str, str]]):
+        """Changes the types of `columns` ((name, type) pairs), keeping the rows"""
+
+    def begin_bulk_load(self, table: str):
+        pass
+
+    def end_bulk_load(self, table: str):
+        pass
+
+    def concurrent_loads(self, auto_increment: bool) -> bool:
+        """
+        Whether `load_csv` calls on several connections into one table can
+        run at the same time. auto_increment: the table has an
+        AUTO_INCREMENT column
+        """
+        return True
+
+    @abstractmethod
+    def load_csv(
+        self,
+        table: str,
+        path: str,
+        columns: list[str],
+        order: tuple[list[int], int] | None = None,
+        ignore_lines: int = 0,
+    ) -> int:
+        """Loads the csv at `path` into `columns` and returns the number of rows"""
+
+
+class MariaDBBackend(Backend):
+    table_options = " DEFAULT CHARSET=utf8 COLLATE=utf8_bin"
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        # table -> secondary indexes dropped by `begin_bulk_load`
+        self._deferred_indexes: dict[str, list] = {}
+
+    def table_exists(self, table: str) -> bool:
+        rows = self.query(
+            f"""
+            SELECT COUNT(*)
+            FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = "{table}"
+            """
+        )
+        return rows[0][0] > 0
+
+    def column_exists(self, table: str, column: str) -> bool:
+        rows = self.query(
+            f"""
+            SELECT COUNT(*)
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = "{table}"
+                AND column_name = "{column}"
+            """
+        )
+        return rows[0][0] > 0
+
+    def index_exists(self, table: str, index: str) -> bool:
+        rows = self.query(
+            f"""
+            SELECT COUNT(*)
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = "{table}"
+                AND index_name = "{index}"
+            """
+        )
+        return rows[0][0] > 0
+
+    def table_versions(self, tables: list[str]) -> list:
+        in_tables = ", ".join(f"'{t}'" for t in tables)
+        rows = self.query(
+            f"""
+            SELECT table_name, create_time, update_time, table_rows
+            FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name IN ({in_tables})
+            ORDER BY table_name
+            """
+        )
+        return [tuple(map(str, row)) for row in rows]
+
+    def auto_increment_primary_key(self, name: str) -> str:
+        return f"`{name}` bigint(20) unsigned NOT NULL AUTO_INCREMENT PRIMARY KEY"
+
+    def drop_temporary_table(self, name: str):
+        self.execute(f"DROP TEMPORARY TABLE IF EXISTS `{name}`")
+
+    def add_index(self, table: str, columns: list[str], name: str | None = None):
+        columns = ", ".join(f"`{c}`" for c in columns)
+        self.execute(
+            f"""
+            ALTER TABLE `{table}`
+            ADD INDEX {f"`{name}`" if name else ""}({columns})
+            """
+        )
+
+    def add_primary_key(self, table: str, field: str):
+        self.execute(
+            f"""
+            ALTER TABLE `{table}`
+            ADD PRIMARY KEY (`{field}`)
+            """
+        )
+
+    def add_row_ids(self, table: str, name: str):
+        # Appended rows are numbered by AUTO_INCREMENT.
+        if not self.column_exists(table, name):
+            self.execute(
+                f"ALTER TABLE `{table}` ADD COLUMN {self.auto_increment_primary_key(name)}"
+            )
+
+    def modify_columns(self, table: str, columns: list[tuple[str, str]]):
+        modify = ", ".join(f"MODIFY `{key}` {rem}" for key, rem in columns)
+        self.execute(f"ALTER TABLE `{table}` {modify}")
+
+    def begin_bulk_load(self, table: str):
+        # DISABLE KEYS does nothing on InnoDB, so the secondary indexes of an
+        # empty table are dropped here and built once in `end_bulk_load`. A
+        # table that already has rows keeps them, as rebuilding them for all
+        # its rows would cost more than maintaining them for the new ones.
+        self._deferred_indexes[table] = []
+        if self.query(f"SELECT 1 FROM `{table}` LIMIT 1"):
+            return
+        indexes = self.query(
+            f"""
+            SELECT index_name, non_unique, index_type, GROUP_CONCAT(
+                CONCAT('`', column_name, '`', IFNULL(CONCAT('(', sub_part, ')'), ''))
+                ORDER BY seq_in_index SEPARATOR ', '
+            )
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = "{table}"
+                AND index_name != 'PRIMARY'
+            GROUP BY index_name, non_unique, index_type
+            """
+        )
+        if indexes:
+            drops = ", ".join(f"DROP INDEX `{name}`" for name, *_ in indexes)
+            self.execute(f"ALTER TABLE `{table}` {drops}")
+            self._deferred_indexes[table] = indexes
+
+    def end_bulk_load(self, table: str):
+        indexes = self._deferred_indexes.pop(table, [])
+        if not indexes:
+            return
+        adds = []
+        for name, non_unique, index_type, columns in indexes:
+            if index_type in ("SPATIAL", "FULLTEXT"):
+                kind = f"{index_type} INDEX"
+            else:
+                kind = "INDEX" if int(non_unique) else "UNIQUE INDEX"
+            adds.append(f"ADD {kind} `{name}` ({columns})")
+        self.execute(f"ALTER TABLE `{table}` {', '.join(adds)}")
+
+    def concurrent_loads(self, auto_increment: bool) -> bool:
+        # Unless innodb_autoinc_lock_mode is 2 ("interleaved"), InnoDB holds a
+        # table level AUTO-INC lock for the whole of each LOAD DATA, so loads
+        # into a table with an AUTO_INCREMENT column run one after another.
+        # The mode can only be set in the server configuration, and mode 2
+        # needs row based binary logging if the server replicates.
+        if not auto_increment:
+            return True
+        return self.query("SELECT @@innodb_autoinc_lock_mode")[0][0] == 2
+
+    def load_csv(
+        self,
+        table: str,
+        path: str,
+        columns: list[str],
+        order: tuple[list[int], int] | None = None,
+        ignore_lines: int = 0,
+    ) -> int:
+        statement = rf"""
+        LOAD DATA LOCAL INFILE "{path}"
+        INTO TABLE `{table}`
+        FIELDS TERMINATED BY ','
+        OPTIONALLY ENCLOSED by '"'
+        LINES STARTING BY ''
+        TERMINATED BY '\n'
+        IGNORE {ignore_lines or 0} lines
+        """
+        if order is not None:
+            positions, size = order
+            upload = ["@dummy"] * size
+            for key, idx in zip(columns, positions):
+                upload[idx] = f"`{key}`"
+
+            statement = f"""
+            {statement}
+            ({", ".join(upload)})
+            """
+        echo(statement)
+
+        cur = self.conn.cursor()
+        cur.execute("SET SESSION unique_checks = 0")
+        try:
+            return cur.execute(statement)
+        finally:
+            cur.execute("SET SESSION unique_checks = 1")
+            cur.close()
+
+
+class SQLiteBackend(Backend):
+    """
+    Embedded backend, useful for local and offline runs. MariaDB column types
+    are mapped to their SQLite affinity. Spatial indexes and the normalised
+    OSM layout are only supported on MariaDB.
+    """
+
+    param = "?"
+
+    def column_type(self, rem: str) -> str:
+        rem = re.sub(r"enum\((?:'(?:[^']|'')*'|[\s,])*\)", "text", rem, flags=re.I)
+        rem = re.sub(r"\s*\bunsigned\b", "", rem, flags=re.I)
+        rem = re.sub(r"\b(\w*int)\(\d+\)", r"\1", rem, flags=re.I)
+        return rem
+
+    def table_exists(self, table: str) -> bool:
+        rows = self.query(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?",
+            (table,),
+        )
+        return rows[0][0] > 0
+
+    def column_exists(self, table: str, column: str) -> bool:
+        return any(row[1] == column for row in self.query(f"PRAGMA table_info(`{table}`)"))
+
+    def index_exists(self, table: str, index: str) -> bool:
+        rows = self.query(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name = ?",
+            (self._index_name(table, index),),
+        )
+        return rows[0][0] > 0
+
+    def table_versions(self, tables: list[str]) -> list:
+        versions = []
+        for table in sorted(tables):
+            if self.table_exists(table):
+                sql = self.query(
+                    "SELECT sql FROM sqlite_master WHERE name = ?", (table,)
+                )[0][0]
+                versions.append((table, sql, str(self.count(table))))
+        return versions
+
+    def auto_increment_primary_key(self, name: str) -> str:
+        return f"`{name}` INTEGER PRIMARY KEY"
+
+    def drop_temporary_table(self, name: str):
+        self.execute(f"DROP TABLE IF EXISTS temp.`{name}`")
+
+    def _index_name(self, table: str, name: str) -> str:
+        # Index names are global in SQLite, not per table.
+        return f"{table}_{name}"
+
+    def add_index(self, table: str, columns: list[str], name: str | None = None):
+        name = self._index_name(table, name or "_".join(columns))
+        columns = ", ".join(f"`{c}`" for c in columns)
+        self.execute(f"CREATE INDEX IF NOT EXISTS `{name}` ON `{table}` ({columns})")
+
+    def add_primary_key(self, table: str, field: str):
+        # SQLite can't add a primary key to an existing table.
+        name = self._index_name(table, "PRIMARY")
+        self.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS `{name}` ON `{table}` (`{field}`)")
+
+    def add_row_ids(self, table: str, name: str):
+        if not self.column_exists(table, name):
+            self.execute(f"ALTER TABLE `{table}` ADD COLUMN `{name}` INTEGER")
+            self.add_primary_key(table, name)
+        self.execute(f"UPDATE `{table}` SET `{name}` = rowid WHERE `{name}` IS NULL")
+
+    def modify_columns(self, table: str, columns: list[tuple[str, str]]):
+        # SQLite can't change the type of a column, and the type decides how
+        # values are stored ("007" becomes 7 in an integer column), so the
+        # table is copied into one created with the new types.
+        rows = self.query(
+            "SELECT type, sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL",
+            (table,),
+        )
+        create = next(sql for kind, sql in rows if kind == "table")
+        indexes = [sql for kind, sql in rows if kind == "index"]
+        for key, rem in columns:
+            create = re.sub(
+                rf"^`{re.escape(key)}` .*?(?=,?$)",
+                lambda _: f"`{key}` {self.column_type(rem)}",
+                create,
+                count=1,
+                flags=re.M,
+            )
+        copy = f"{table}__modify"
+        self.execute(f"DROP TABLE IF EXISTS `{copy}`")
+        self.execute(create.replace(f"`{table}`", f"`{copy}`", 1))
+        self.execute(f"INSERT INTO `{copy}` SELECT * FROM `{table}`")
+        self.execute(f"DROP TABLE `{table}`")
+        self.execute(f"ALTER TABLE `{copy}` RENAME TO `{table}`")
+        for sql in indexes:
+            self.execute(sql)
+
+    def load_csv(
+        self,
+        table: str,
+        path: str,
+        columns: list[str],
+        order: tuple[list[int], int] | None = None,
+        ignore_lines: int = 0,
+    ) -> int:
+        positions = order[0] if order is not None else range(len(columns))
+        positions = list(positions)
+        names = ", ".join(f"`{c}`" for c in columns)
+        params = ", ".join("?" for _ in columns)
+        statement = f"INSERT INTO `{table}` ({names}) VALUES ({params})"
+        echo(f"{statement} <- {path}")
+
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            for _ in range(ignore_lines or 0):
+                next(reader, None)
+            rows = (
+                [row[i] if i < len(row) else None for i in positions] for row in reader
+            )
+            cur = self.conn.cursor()
+            cur.executemany(statement, rows)
+            count = cur.rowcount
+            cur.close()
+        return count
+
+
+def get_backend(conn) -> Backend:
+    if isinstance(conn, Backend):
+        return conn
+    if isinstance(conn, sqlite3.Connection):
+        return SQLiteBackend(conn)
+    return MariaDBBackend(conn)
+
+
+def is_embedded(conn) -> bool:
+    return isinstance(get_backend(conn), SQLiteBackend)
+
+
+def create_embedded_connection(path: str = ":memory:") -> sqlite3.Connection:
+    """An embedded database at `path` that can be used instead of MariaDB"""
+    conn = sqlite3.connect(
+        path, check_same_thread=False, factory=InstrumentedSQLiteConnection
+    )
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    print("Connection established!")
+    return conn
@@ -4,14 +4,18 @@ import pandas as pd
 import pymysql
 
 from fynesse import access
-from fynesse.access.utils import UploadCsvConfig, get_download_path, normalise_df
+from fynesse.access.utils import (
+    UploadCsvConfig,
+    get_download_path,
+    read_sql,
+)
 
 
 COLUMNS_MAP = {
     "ts062": [
-        ("date", "tinytext NOT NULL"),
-        ("geography", "tinytext NOT NULL"),
-        ("geography_code", "tinytext NOT NULL"),
+        ("date", None),
+        ("geography", None),
+        ("geography_code", None),
         ("all", "int(10) unsigned NOT NULL"),
         ("L1-L3", "int(10) unsigned NOT NULL"),
         ("L4-L6", "int(10) unsigned NOT NULL"),
@@ -79,9 +83,9 @@ def upload_nssec(conn, level: str):
         name=f"nssec_{level}_2021",
         path=path,
         columns=[
-            ("date", "tinytext NOT NULL"),
-            ("geography", "tinytext NOT NULL"),
-            ("geography_code", "tinytext NOT NULL"),
+            ("date", None),
+            ("geography", None),
+            ("geography_code", None),
             ("all", "int(10) unsigned NOT NULL"),
             ("L1-L3", "int(10) unsigned NOT NULL"),
             ("L4-L6", "int(10) unsigned NOT NULL"),
@@ -101,27 +105,56 @@ def upload_nssec(conn, level: str):
     config.upload(conn)
 
 
+# The lookup table and its geography code column for each census level
+CONSTITUENCY_LOOKUPS = {
+    "msoa": ("msoa_2021_to_constituency_2024", "MSOA21CD"),
+    "oa": ("oa_2021_to_constituency_2024", "OA21CD"),
+}
+
+# Columns of every census table that are not counts
+GEOGRAPHY_COLUMNS = ["date", "geography", "geography_code"]
+
+
 def load_census_2021_for_constituency(
     conn: pymysql.Connection,
     code: str,
     normalise: bool = False,
+    cache: bool = False,
+    level: str = "msoa",
+    columns: list[str] | None = None,
 ) -> pd.DataFrame:
     """
-    Sum the values for each column over all MSOAs in the constituency
+    Sum the values for each column over all MSOAs (or OAs) in the constituency.
+    The sums are computed by the database, so only one row per constituency
+    is fetched.
+    columns: the count columns to load, all of them by default. The first
+        count column of the table (the total) is always included.
+    normalise: divide every column by the total and drop the total.
     """
-    table = f"`{code}_msoa_2021`"
+    lookup, lookup_code = CONSTITUENCY_LOOKUPS[level]
+    counts = [key for key, _ in COLUMNS_MAP[code] if key not in GEOGRAPHY_COLUMNS]
+    total = counts[0]
+    if columns is not None:
+        counts = [total] + [c for c in columns if c != total]
 
+    if normalise:
+        sums = [
+            f"SUM(c.`{c}`) / CAST(SUM(c.`{total}`) AS DOUBLE) AS `{c}`"
+            for c in counts[1:]
+        ]
+    else:
+        sums = [f"SUM(c.`{c}`) AS `{c}`" for c in counts]
+
+    table = f"{code}_{level}_2021"
     statement = f"""
-    SELECT *
-    FROM {table}
-    INNER JOIN msoa_2021_to_constituency_2024 ON {table}.geography_code = msoa_2021_to_constituency_2024.MSOA21CD
+    SELECT l.PCON25CD, {", ".join(sums)}
+    FROM `{table}` AS c
+    INNER JOIN `{lookup}` AS l ON c.geography_code = l.{lookup_code}
+    GROUP BY l.PCON25CD
+    ORDER BY l.PCON25CD
     """
-    df = pd.read_sql(statement, conn)
-    df.drop(
-        columns=["date", "geography", "geography_code", "id", "MSOA21CD"], inplace=True
-    )
+    df = read_sql(statement, conn, [table, lookup], cache)
+    df.set_index("PCON25CD", inplace=True)
 
-    df: pd.DataFrame = df.groupby("PCON25CD").sum()
-    if normalise:
-        normalise_df(df, list(df.columns)[1:], target="all", keep=False, in_place=True)
-    return df
+    # MariaDB returns SUM of integers as DECIMAL
+    return df.astype("float64" if normalise else "int64")
@@ -0,0 +1,150 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from fynesse.access.census import (
+    download_census_data_2021,
+    get_census_2021_download_csv,
+)
+from fynesse.access.utils import get_download_path
+
+
+# Leading columns of every census csv: date, geography, geography code
+_GEOGRAPHY_COLUMNS = 3
+_CODE_COLUMN = 2
+
+
+def get_census_matrix_path(name: str) -> str:
+    return get_download_path(f"census/matrix/{name}/")
+
+
+class CensusMatrix:
+    """
+    Wide (areas x columns) matrix of census counts for many census tables.
+    `values` is a read-only memory map, so opening is cheap and worker
+    processes that open the same matrix share its pages.
+    areas: the area code of every row
+    columns: (code, column name) of every column
+    """
+
+    def __init__(self, values: np.ndarray, areas, columns: list[tuple[str, str]]):
+        self.values = values
+        self.areas = np.asarray(areas)
+        self.columns = [tuple(c) for c in columns]
+        self._rows = pd.Index(self.areas)
+        self._columns = {c: i for i, c in enumerate(self.columns)}
+
+    @classmethod
+    def open(cls, name: str) -> "CensusMatrix":
+        path = get_census_matrix_path(name)
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        values = np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+        areas = np.load(os.path.join(path, "areas.npy"))
+        return cls(values, areas, meta["columns"])
+
+    def __repr__(self):
+        return f"CensusMatrix({len(self.areas)} areas x {len(self.columns)} columns)"
+
+    def column_indices(self, code: str, columns: list[str] | None = None) -> list[int]:
+        """Positions of `columns` (all by default) of census table `code`"""
+        if columns is None:
+            return [i for i, (c, _) in enumerate(self.columns) if c == code]
+        return [self._columns[(code, column)] for column in columns]
+
+    def rows(self, areas) -> np.ndarray:
+        """Positions of the rows for `areas`, raising KeyError if any is missing"""
+        positions = self._rows.get_indexer(np.asarray(areas))
+        if (positions < 0).any():
+            missing = np.asarray(areas)[positions < 0]
+            raise KeyError(f"Areas not in the matrix: {list(missing[:10])}")
+        return positions
+
+    def to_df(self, code: str | None = None, areas=None) -> pd.DataFrame:
+        """A copy of the columns of `code` (all by default) for `areas`"""
+        cols = (
+            list(range(len(self.columns)))
+            if code is None
+            else self.column_indices(code)
+        )
+        rows = slice(None) if areas is None else self.rows(areas)
+        index = self.areas if areas is None else np.asarray(areas)
+        return pd.DataFrame(
+            self.values[rows][:, cols],
+            index=index,
+            columns=pd.MultiIndex.from_tuples([self.columns[i] for i in cols]),
+        )
+
+
+def build_census_matrix(
+    name: str,
+    codes: list[str],
+    level: str = "oa",
+    dtype: str = "uint32",
+    rebuild: bool = False,
+) -> CensusMatrix:
+    """
+    Downloads the census tables `codes` at `level` and stores all their count
+    columns in one `CensusMatrix` called `name`. The rows are the union of
+    the areas of every table, sorted by code; counts missing from a table
+    are 0 (NaN for float dtypes).
+    dtype: "uint32" or "float32"
+    An existing matrix with the same codes, level and dtype is reused.
+    """
+    path = get_census_matrix_path(name)
+    meta_path = os.path.join(path, "meta.json")
+    spec = {"codes": list(codes), "level": level, "dtype": dtype}
+
+    if os.path.exists(meta_path) and not rebuild:
+        with open(meta_path) as f:
+            if {k: v for k, v in json.load(f).items() if k in spec} == spec:
+                return CensusMatrix.open(name)
+
+    csvs = []
+    for code in codes:
+        download_census_data_2021(code)
+        csvs.append(get_census_2021_download_csv(code, level))
+
+    # Only the area codes and headers are needed to lay out the matrix.
+    areas = set()
+    columns = []
+    for code, csv_path in zip(codes, csvs):
+        header = pd.read_csv(csv_path, nrows=0).columns
+        columns.extend((code, column) for column in header[_GEOGRAPHY_COLUMNS:])
+        areas.update(pd.read_csv(csv_path, usecols=[_CODE_COLUMN]).iloc[:, 0])
+    areas = np.array(sorted(areas))
+    rows = pd.Index(areas)
+
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    # Written under a temporary name so a failed build is never opened.
+    values_tmp = os.path.join(path, "values.tmp.npy")
+    values = np.lib.format.open_memmap(
+        values_tmp, mode="w+", dtype=dtype, shape=(len(areas), len(columns))
+    )
+    values[:] = np.nan if np.dtype(dtype).kind == "f" else 0
+
+    start = 0
+    for csv_path in csvs:
+        header = pd.read_csv(csv_path, nrows=0).columns
+        df = pd.read_csv(
+            csv_path,
+            usecols=[_CODE_COLUMN, *range(_GEOGRAPHY_COLUMNS, len(header))],
+            dtype={column: dtype for column in header[_GEOGRAPHY_COLUMNS:]},
+        )
+        counts = df.iloc[:, 1:].to_numpy()
+        positions = rows.get_indexer(df.iloc[:, 0])
+        values[positions, start : start + counts.shape[1]] = counts
+        start += counts.shape[1]
+
+    values.flush()
+    del values
+    os.replace(values_tmp, os.path.join(path, "values.npy"))
+    np.save(os.path.join(path, "areas.npy"), areas.astype(str))
+    with open(meta_path, "w") as f:
+        json.dump({**spec, "columns": columns}, f)
+
+    return CensusMatrix.open(name)
@@ -1,13 +1,21 @@
 import pandas as pd
 import numpy as np
-import haversine
 import typing
 import enum
+from sklearn.neighbors import BallTree
 
-from fynesse.access.osm.download import get_box_coords, get_osm_counts
+from fynesse.access.utils import read_sql
+from fynesse.access.osm.download import (
+    EARTH_RADIUS_KM,
+    get_box_coords,
+    get_box_coords_array,
+    get_osm_counts,
+    get_osm_counts_batched,
+    get_osm_counts_multi,
+)
 
 
-def get_nssec_oa_boundary_2021(conn, oa: str):
+def get_nssec_oa_boundary_2021(conn, oa: str, cache: bool = False):
     statement = f"""
     SELECT * FROM (
         SELECT * FROM nssec_oa_2021
@@ -19,36 +27,106 @@ def get_nssec_oa_boundary_2021(conn, oa: str):
     ) AS b ON ns.geography = b.oa
     """
 
-    return pd.read_sql(statement, con=conn)
+    return read_sql(statement, conn, ["nssec_oa_2021", "oa_boundaries_2021"], cache)
+
+
+def get_oa_coordinates_2021(conn, oas: list[str]) -> pd.DataFrame:
+    """
+    Returns the centroid (lat, lon) of every OA in `oas`, indexed by OA and in
+    the same order as `oas`. Like `get_nssec_oa_boundary_2021`, only OAs that
+    are also in `nssec_oa_2021` are found.
+    """
+    in_oas = ", ".join(f"'{oa}'" for oa in set(oas))
+    statement = f"""
+    SELECT b.oa, b.lat, b.lon FROM oa_boundaries_2021 AS b
+    INNER JOIN nssec_oa_2021 AS ns ON ns.geography = b.oa
+    WHERE b.oa IN ({in_oas})
+    """
+
+    df = pd.read_sql(statement, con=conn)
+    df = df.drop_duplicates("oa").set_index("oa")
+    missing = [oa for oa in oas if oa not in df.index]
+    if missing:
+        raise KeyError(f"No boundary found for OAs: {missing}")
+    return df.loc[list(oas)]
 
 
 def nearest_entry(df, lat, lon):
     """The distance in km"""
-    return min(
-        haversine.haversine((lat, lon), (row.lat, row.lon)) for _, row in df.iterrows()
-    )
+    return float(nearest_entries(df, [lat], [lon])[0])
+
+
+def build_nearest_tree(df: pd.DataFrame) -> BallTree:
+    """BallTree over the (lat, lon) of every row of `df` for `nearest_entries`"""
+    points = np.radians(df[["lat", "lon"]].to_numpy(dtype=np.float64))
+    return BallTree(points, metric="haversine")
+
+
+def nearest_entries(
+    df_or_tree: pd.DataFrame | BallTree, lats, lons, k: int = 1
+) -> np.ndarray:
+    """
+    The haversine distance in km from every (lat, lon) to the nearest row of
+    `df_or_tree`, or to each of the `k` nearest rows (shape (N, k)) if k > 1.
+    Pass a tree from `build_nearest_tree` to reuse it across calls.
+    """
+    tree = df_or_tree
+    if not isinstance(tree, BallTree):
+        tree = build_nearest_tree(tree)
+
+    points = np.radians(np.column_stack([lats, lons]).astype(np.float64))
+    dist, _ = tree.query(points, k=k)
+    dist *= EARTH_RADIUS_KM
+    return dist[:, 0] if k == 1 else dist
 
 
 class Feature(enum.Enum):
+    # (distance, key, value): the number of nodes in the box of side `distance`
+    # km. With a list of distances there is one column per distance, all
+    # counted from a single query. (distances, key, value, True) counts the
+    # nodes within each distance instead, see `get_osm_counts_multi`.
     Count = enum.auto()
+    # df: the distance in km to the nearest row of df
     Distance = enum.auto()
 
 
+def _is_multi_count(feature_val) -> bool:
+    dist = feature_val[0]
+    return isinstance(dist, (list, tuple, np.ndarray)) or len(feature_val) > 3
+
+
+def _multi_count(conn, feature_val, lats, lons, backend: str = "sql") -> np.ndarray:
+    dist, key, value, *rest = feature_val
+    distances = list(dist) if isinstance(dist, (list, tuple, np.ndarray)) else [dist]
+    haversine = bool(rest[0]) if rest else False
+    return get_osm_counts_multi(
+        conn, key, value, lats, lons, distances, haversine, backend=backend
+    )
+
+
 def get_features(conn, oas, features: list[tuple[Feature, typing.Any]]):
+    trees = {
+        i: build_nearest_tree(feature_val)
+        for i, (feature_type, feature_val) in enumerate(features)
+        if feature_type == Feature.Distance
+    }
+
     res = []
     for oa in oas:
         nssec_boundary = get_nssec_oa_boundary_2021(conn, oa)
         lat, lon = nssec_boundary.lat[0], nssec_boundary.lon[0]
 
         arr = []
-        for feature_type, feature_val in features:
-            if feature_type == Feature.Count:
+        for i, (feature_type, feature_val) in enumerate(features):
+            if feature_type == Feature.Count and _is_multi_count(feature_val):
+                arr.extend(_multi_count(conn, feature_val, [lat], [lon])[0])
+            elif feature_type == Feature.Count:
                 dist, key, value = feature_val
                 coords = get_box_coords(lat, lon, dist)
                 count = get_osm_counts(conn, key, value, coords)
                 arr.append(count)
             else:
-                value = nearest_entry(feature_val, lat, lon)
+                value = nearest_entries(trees[i], [lat], [lon])[0]
                 arr.append(value)
 
         res.append(np.array(arr))
@@ -56,6 +134,35 @@ def get_features(conn, oas, features: list[tuple[Feature, typing.Any]]):
     return np.array(res)
 
 
+def get_features_batched(
+    conn, oas, features: list[tuple[Feature, typing.Any]], backend: str = "sql"
+):
+    """
+    Same result as `get_features`, but the OA centroids are fetched in one
+    query and every Count feature is a single set-based query over all OAs.
+    backend: passed to `get_osm_counts_batched`
+    """
+    centroids = get_oa_coordinates_2021(conn, oas)
+    lats, lons = centroids.lat.to_numpy(), centroids.lon.to_numpy()
+
+    columns = []
+    for feature_type, feature_val in features:
+        if feature_type == Feature.Count and _is_multi_count(feature_val):
+            columns.extend(_multi_count(conn, feature_val, lats, lons, backend).T)
+        elif feature_type == Feature.Count:
+            dist, key, value = feature_val
+            coords = get_box_coords_array(lats, lons, dist)
+            columns.append(
+                get_osm_counts_batched(conn, key, value, coords, backend=backend)
+            )
+        else:
+            columns.append(nearest_entries(feature_val, lats, lons))
+
+    if not columns:
+        return np.empty((len(oas), 0))
+    return np.column_stack(columns)
+
+
 def get_students(conn, oas):
     statement = f"""
     SELECT `all`, L15 FROM nssec_oa_2021
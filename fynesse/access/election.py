@@ -1,3 +1,5 @@
+import csv
+
 import geopandas as gpd
 import pandas as pd
 from pymysql import Connection
@@ -9,6 +11,7 @@ from fynesse.access.utils import (
     get_download_path,
     load_table_df,
     normalise_df,
+    read_sql,
 )
 
 
@@ -31,12 +34,12 @@ ALL_PARTIES = [
 
 def _create_columns(parties: list[str]):
     columns = [
-        ("ONS_ID", "tinytext NOT NULL"),
-        ("Constituency_name", "tinytext NOT NULL"),
-        ("Country_name", "tinytext NOT NULL"),
-        ("Result", "tinytext NOT NULL"),
-        ("First_party", "tinytext NOT NULL"),
-        ("Second_party", "tinytext NOT NULL"),
+        ("ONS_ID", None),
+        ("Constituency_name", None),
+        ("Country_name", None),
+        ("Result", None),
+        ("First_party", None),
+        ("Second_party", None),
         ("Electorate", "int(10) NOT NULL"),
         ("Valid_votes", "int(10) NOT NULL"),
         ("Invalid_votes", "int(10) NOT NULL"),
@@ -90,9 +93,9 @@ def upload_election(conn: Connection, year: int, recreate=True):
     ).upload(conn)
 
 
-def load_election_df(conn: Connection, year: int):
+def load_election_df(conn: Connection, year: int, cache: bool = False):
     table = f"election_{year}"
-    df = load_table_df(conn, table)
+    df = load_table_df(conn, table, cache)
     return df
 
 
@@ -161,8 +164,8 @@ def upload_msoa_2021_to_constituency_2024(conn: Connection, recreate=True):
         name="msoa_2021_to_constituency_2024",
         path=path,
         columns=[
-            ("MSOA21CD", "tinytext NOT NULL"),
-            ("PCON25CD", "tinytext NOT NULL"),
+            ("MSOA21CD", None),
+            ("PCON25CD", None),
         ],
         primary_key="id",
         order=([0, 3], 10),
@@ -171,13 +174,38 @@ def upload_msoa_2021_to_constituency_2024(conn: Connection, recreate=True):
     ).upload(conn)
 
 
-def load_join_msoa_to_election_2021(conn: Connection):
+def upload_oa_2021_to_constituency_2024(conn: Connection, path: str, recreate=True):
+    """
+    Uploads an OA (2021) to constituency (2024) lookup csv from the ONS Open
+    Geography Portal, which has no stable download link. Only the OA21CD and
+    PCON25CD columns are kept, wherever they are in the file.
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        header = next(csv.reader(f))
+
+    UploadCsvConfig(
+        name="oa_2021_to_constituency_2024",
+        path=path,
+        columns=[
+            ("OA21CD", None),
+            ("PCON25CD", None),
+        ],
+        primary_key="id",
+        order=([header.index("OA21CD"), header.index("PCON25CD")], len(header)),
+        recreate=recreate,
+        ignore_lines=1,
+    ).upload(conn)
+
+
+def load_join_msoa_to_election_2021(conn: Connection, cache: bool = False):
     statement = """
     SELECT *
     FROM election_2024
     INNER JOIN msoa_2021_to_constituency_2024 ON election_2024.ONS_ID = msoa_2021_to_constituency_2024.PCON25CD
     """
-    return pd.read_sql(statement, conn)
+    return read_sql(
+        statement, conn, ["election_2024", "msoa_2021_to_constituency_2024"], cache
+    )
 
 
 def join_election_census_df(election_df: pd.DataFrame, census_df: pd.DataFrame):
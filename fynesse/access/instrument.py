@@ -0,0 +1,362 @@
+"""
+Timings of the SQL statements and downloads made by `fynesse.access`.
+
+Connections from `create_connection`, `create_embedded_connection` and
+`ConnectionPool` use the cursors below, which report every statement to this
+module. Nothing is recorded until `enable` is called:
+
+    instrument.enable(trace_path="trace.jsonl")
+    ...
+    instrument.report()
+
+Statements are grouped by their fingerprint, the statement with literals
+replaced by `?`, so the same query with different arguments is aggregated.
+"""
+
+import json
+import re
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+import pandas as pd
+import pymysql.cursors
+
+from fynesse.config import config
+
+
+@dataclass
+class Record:
+    kind: str
+    fingerprint: str
+    statement: str
+    call_site: str
+    start: float
+    duration: float = 0.0
+    rows: int = 0
+    # Estimate of the bytes sent and, for SQL, received
+    bytes: int = 0
+    error: str | None = None
+
+
+class _State:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.echo = config.get("echo_sql", True)
+        self.trace = None
+        # fingerprint -> [kind, count, total, max, rows, bytes, errors]
+        self.statements: dict[str, list] = {}
+        # call site -> [count, total, rows, bytes]
+        self.call_sites: dict[str, list] = {}
+
+
+_state = _State()
+
+# Frames of these modules are never reported as the call site of a statement.
+_SKIP_MODULES = (
+    "fynesse.access.instrument",
+    "fynesse.access.backend",
+    "fynesse.access.utils",
+    "pandas",
+    "pymysql",
+    "sqlite3",
+    "contextlib",
+    "concurrent",
+    "threading",
+)
+
+# Statements longer than this are truncated in the trace
+_MAX_STATEMENT = 2000
+
+# Rows sampled by `_result_bytes`
+_SAMPLE_ROWS = 100
+
+
+def enable(trace_path: str | None = None, echo: bool = False):
+    """
+    Starts recording. Every record is also appended to the JSONL file
+    `trace_path` if given.
+    echo: keep printing the statements that the helpers print
+    """
+    with _state.lock:
+        if _state.trace is not None:
+            _state.trace.close()
+        _state.trace = open(trace_path, "a") if trace_path else None
+        _state.enabled = True
+        _state.echo = echo
+
+
+def disable():
+    with _state.lock:
+        if _state.trace is not None:
+            _state.trace.close()
+        _state.trace = None
+        _state.enabled = False
+        _state.echo = config.get("echo_sql", True)
+
+
+def reset():
+    """Clears the aggregates"""
+    with _state.lock:
+        _state.statements.clear()
+        _state.call_sites.clear()
+
+
+def is_enabled() -> bool:
+    return _state.enabled
+
+
+def echo(message: str):
+    """Prints `message` unless echoing is turned off, see `enable`"""
+    if _state.echo:
+        print(message)
+
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_NUMBER = re.compile(r"(?<![\w`])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?(?![\w`])", re.I)
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_LISTS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+
+
+def fingerprint(statement: str) -> str:
+    """`statement` with literals replaced by `?` and lists of them by `(...)`"""
+    statement = _STRING.sub("?", statement)
+    statement = _NUMBER.sub("?", statement)
+    statement = statement.replace("%s", "?")
+    statement = _LIST.sub("(...)", statement)
+    statement = _LISTS.sub("(...)", statement)
+    return " ".join(statement.split())
+
+
+def _result_bytes(rows) -> int:
+    """
+    Estimate of the size of the fetched `rows`, extrapolated from the
+    first `_SAMPLE_ROWS` so large results stay cheap to measure.
+    """
+    if not rows:
+        return 0
+    sample = rows[:_SAMPLE_ROWS]
+    size = 0
+    for row in sample:
+        for value in row:
+            if isinstance(value, (str, bytes, bytearray)):
+                size += len(value)
+            elif value is not None:
+                # Numbers, dates and decimals
+                size += 8
+    return size * len(rows) // len(sample)
+
+
+def _call_site() -> str:
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if not module.startswith(_SKIP_MODULES):
+            return f"{module}.{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return "<unknown>"
+
+
+def start(kind: str, statement: str, nbytes: int = 0) -> Record | None:
+    """A new record, or None if recording is disabled. See `finish`."""
+    if not _state.enabled:
+        return None
+    return Record(
+        kind=kind,
+        fingerprint=fingerprint(statement) if kind == "sql" else statement,
+        statement=statement[:_MAX_STATEMENT],
+        call_site=_call_site(),
+        start=time.time(),
+        bytes=nbytes,
+    )
+
+
+def finish(record: Record | None):
+    """Adds a record from `start` to the aggregates and the trace"""
+    if record is None:
+        return
+    with _state.lock:
+        stats = _state.statements.setdefault(
+            record.fingerprint, [record.kind, 0, 0.0, 0.0, 0, 0, 0]
+        )
+        stats[1] += 1
+        stats[2] += record.duration
+        stats[3] = max(stats[3], record.duration)
+        stats[4] += record.rows
+        stats[5] += record.bytes
+        stats[6] += record.error is not None
+
+        site = _state.call_sites.setdefault(record.call_site, [0, 0.0, 0, 0])
+        site[0] += 1
+        site[1] += record.duration
+        site[2] += record.rows
+        site[3] += record.bytes
+
+        if _state.trace is not None:
+            _state.trace.write(json.dumps(asdict(record)) + "\n")
+            _state.trace.flush()
+
+
+@contextmanager
+def track(kind: str, statement: str, nbytes: int = 0):
+    """
+    Records the time spent in the block. Yields the record (None if
+    disabled) so the block can fill in `rows` and `bytes`.
+    """
+    record = start(kind, statement, nbytes)
+    begin = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        if record is not None:
+            record.error = repr(e)
+            if hasattr(e, "add_note"):
+                e.add_note(f"{kind} from {record.call_site}: {record.fingerprint}")
+        raise
+    finally:
+        if record is not None:
+            record.duration += time.perf_counter() - begin
+            finish(record)
+
+
+def slowest(n: int = 10) -> pd.DataFrame:
+    """The `n` statements (and downloads) with the most total time"""
+    with _state.lock:
+        rows = [[fp, *stats] for fp, stats in _state.statements.items()]
+    df = pd.DataFrame(
+        rows,
+        columns=["fingerprint", "kind", "count", "total", "max", "rows", "bytes", "errors"],
+    )
+    df["mean"] = df["total"] / df["count"]
+    return df.sort_values("total", ascending=False).head(n).reset_index(drop=True)
+
+
+def by_call_site() -> pd.DataFrame:
+    """Total time, rows and bytes for every call site"""
+    with _state.lock:
+        rows = [[site, *stats] for site, stats in _state.call_sites.items()]
+    df = pd.DataFrame(rows, columns=["call_site", "count", "total", "rows", "bytes"])
+    return df.sort_values("total", ascending=False).reset_index(drop=True)
+
+
+def report(n: int = 10):
+    with pd.option_context("display.max_colwidth", 80, "display.width", 200):
+        print(slowest(n))
+        print()
+        print(by_call_site())
+
+
+class _InstrumentedCursorMixin:
+    """
+    Records every execute. Without a row count (SQLite SELECTs) the record
+    is kept open until the results are fetched, since SQLite only runs most
+    of the query while fetching.
+    """
+
+    _record = None
+
+    def _finish(self):
+        if self._record is not None:
+            record, self._record = self._record, None
+            finish(record)
+
+    def _run(self, method, statement, args, many: bool = False):
+        self._finish()
+        if not _state.enabled:
+            return method(statement, *([] if args is None else [args]))
+
+        # Only an estimate of the bytes sent. The rows of executemany can be
+        # a generator, so only the statement is counted for those.
+        nbytes = len(statement)
+        if args is not None and not many:
+            nbytes += len(repr(args))
+        record = start("sql", statement, nbytes)
+
+        begin = time.perf_counter()
+        try:
+            result = method(statement, *([] if args is None else [args]))
+        except Exception as e:
+            record.duration = time.perf_counter() - begin
+            record.error = repr(e)
+            finish(record)
+            if hasattr(e, "add_note"):
+                e.add_note(f"sql from {record.call_site}: {record.fingerprint}")
+            raise
+        record.duration = time.perf_counter() - begin
+        if self.rowcount >= 0:
+            # The result is complete, pymysql buffers it in execute.
+            record.rows = self.rowcount
+            record.bytes += _result_bytes(getattr(self, "_rows", None))
+            finish(record)
+        else:
+            self._record = record
+        return result
+
+    def _fetched(self, begin: float, rows: list):
+        self._record.duration += time.perf_counter() - begin
+        self._record.rows += len(rows)
+        self._record.bytes += _result_bytes(rows)
+
+    def fetchone(self):
+        if self._record is None:
+            return super().fetchone()
+        begin = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(begin, [] if row is None else [row])
+        return row
+
+    def fetchmany(self, *args):
+        if self._record is None:
+            return super().fetchmany(*args)
+        begin = time.perf_counter()
+        rows = super().fetchmany(*args)
+        self._fetched(begin, rows)
+        return rows
+
+    def fetchall(self):
+        if self._record is None:
+            return super().fetchall()
+        begin = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(begin, rows)
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        return super().close()
+
+    def __del__(self):
+        # Cursors are often dropped without being closed.
+        self._finish()
+
+
+class InstrumentedMySQLCursor(_InstrumentedCursorMixin, pymysql.cursors.Cursor):
+    # executemany is run through execute by pymysql, so it is recorded too.
+    def execute(self, query, args=None):
+        return self._run(super().execute, query, args)
+
+
+class InstrumentedSQLiteCursor(_InstrumentedCursorMixin, sqlite3.Cursor):
+    def execute(self, sql, parameters=None):
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(super().executemany, sql, seq_of_parameters, many=True)
+
+
+class InstrumentedSQLiteConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedSQLiteCursor):
+        return super().cursor(factory)
+
+    # The shortcuts of sqlite3.Connection create their cursor without calling
+    # `cursor`, so they are routed through it here.
+    def execute(self, sql, parameters=None):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
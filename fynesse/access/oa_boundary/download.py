@@ -31,7 +31,7 @@ def upload_2021_oa_boundaries(conn: pymysql.Connection, recreate=True):
         name="oa_boundaries_2021",
         path=path,
         columns=[
-            ("oa", "tinytext"),
+            ("oa", None),
             ("lat", "decimal(11,8)"),
             ("lon", "decimal(10,8)"),
             ("area", "decimal(20,5)"),
@@ -1,19 +1,31 @@
+import numpy as np
 import pandas as pd
+import csv
 import math
+import multiprocessing
 import os
 import osmium
 import pymysql
+import weakref
 import fynesse
+from fynesse.access.backend import get_backend, is_embedded
+from fynesse.access.instrument import echo
 from fynesse.access.utils import (
+    ConnectionPool,
     UploadCsvConfig,
     add_index,
     add_primary_key,
+    add_spatial_index,
+    check_index_exists,
     check_table_exists,
     create_separate_table,
     download_file,
+    execute_statement,
     get_download_path,
+    get_table_versions,
     load_table_df,
 )
+from fynesse.access.osm.index import BoxCountIndex
 
 
 def get_box_coords(latitude, longitude, distance=1.0):
@@ -33,68 +45,239 @@ def get_box_coords(latitude, longitude, distance=1.0):
     return (latitude - dlat, longitude - dlong, latitude + dlat, longitude + dlong)
 
 
+def get_box_coords_array(latitudes, longitudes, distance=1.0) -> np.ndarray:
+    """
+    `get_box_coords` for arrays of points, returning an (N, 4) array of
+    (min_lat, min_long, max_lat, max_long). `distance` may be a scalar or
+    one distance per point.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    distance = np.asarray(distance, dtype=np.float64)
+
+    lat_rad = np.radians(latitudes)
+    mlat = 111132.92 - 559.82 * np.cos(2 * lat_rad) + 1.175 * np.cos(4 * lat_rad)
+    mlong = (
+        111412.84 * np.cos(lat_rad)
+        - 93.5 * np.cos(3 * lat_rad)
+        - 0.11 * np.cos(5 * lat_rad)
+    )
+    dlat = 1 / mlat * 1000 / 2 * distance
+    dlong = 1 / mlong * 1000 / 2 * distance
+    return np.column_stack(
+        np.broadcast_arrays(
+            latitudes - dlat, longitudes - dlong, latitudes + dlat, longitudes + dlong
+        )
+    ).reshape(-1, 4)
+
+
 def download_osm() -> str:
     return download_file(
         "https://download.openstreetmap.fr/extracts/europe/united_kingdom-latest.osm.pbf"
     )
 
 
-def osm_to_csv():
-    osm_filepath = download_osm()
-    basepath = get_download_path("osm/")
+OSM_SKIP_KEYS = {"source", "created_by"}
+
+
+def _read_varint(buf: bytes, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _parse_blob_header(buf: bytes) -> tuple[str, int]:
+    """Returns (type, datasize) of a PBF BlobHeader message"""
+    blob_type = ""
+    datasize = 0
+    pos = 0
+    while pos < len(buf):
+        tag, pos = _read_varint(buf, pos)
+        field, wire = tag >> 3, tag & 0x7
+        if wire == 0:
+            val, pos = _read_varint(buf, pos)
+            if field == 3:
+                datasize = val
+        elif wire == 2:
+            size, pos = _read_varint(buf, pos)
+            if field == 1:
+                blob_type = buf[pos : pos + size].decode()
+            pos += size
+        else:
+            raise ValueError(f"Unexpected wire type {wire} in PBF blob header")
+    return blob_type, datasize
+
+
+def get_pbf_blocks(filepath: str) -> list[tuple[str, int, int]]:
+    """
+    Returns (type, offset, size) for every block in a PBF file.
+    Only the block headers are read, the blob data itself is skipped over.
+    """
+    blocks = []
+    with open(filepath, "rb") as f:
+        while True:
+            offset = f.tell()
+            prefix = f.read(4)
+            if len(prefix) < 4:
+                break
+            header_size = int.from_bytes(prefix, "big")
+            blob_type, datasize = _parse_blob_header(f.read(header_size))
+            f.seek(datasize, os.SEEK_CUR)
+            blocks.append((blob_type, offset, 4 + header_size + datasize))
+    return blocks
+
+
+def _osm_blocks_to_csv(
+    task: tuple[str, str, tuple[int, int], list[tuple[int, int]], int, int, bool]
+) -> int:
+    """
+    Worker for `osm_to_csv`. Writes all tagged nodes contained in the given
+    blocks to `batch_<task_no>_<n>.csv` files in `basepath`, or to
+    `nodes_<task_no>_<n>.csv` and `tags_<task_no>_<n>.csv` files if `normalised`.
+    Returns the number of bytes of the PBF file that were processed.
+    """
+    (
+        osm_filepath,
+        basepath,
+        header,
+        blocks,
+        task_no,
+        target_batch_size,
+        normalised,
+    ) = task
+
+    parts = []
+    with open(osm_filepath, "rb") as f:
+        # Every chunk needs the OSMHeader block to be a valid PBF file.
+        for offset, size in [header] + blocks:
+            f.seek(offset)
+            parts.append(f.read(size))
+    buffer = osmium.io.FileBuffer(b"".join(parts), "pbf")
+
+    batch_no = 0
+    batch = []
+    nodes = []
+
+    def write_rows(prefix, rows):
+        filepath = os.path.join(basepath, f"{prefix}_{task_no:05}_{batch_no}.csv")
+        with open(filepath, "w", newline="") as f:
+            csv.writer(f, lineterminator="\n").writerows(rows)
+        rows.clear()
+
+    def write_batch():
+        nonlocal batch_no
+        if normalised:
+            write_rows("nodes", nodes)
+            write_rows("tags", batch)
+        else:
+            write_rows("batch", batch)
+        batch_no += 1
+
+    for obj in osmium.FileProcessor(buffer, osmium.osm.NODE).with_filter(
+        osmium.filter.EmptyTagFilter()
+    ):
+        timestamp = obj.timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        osm_id, lat, lon = obj.id, obj.lat, obj.lon
+        tags = [(tag.k, tag.v) for tag in obj.tags if tag.k not in OSM_SKIP_KEYS]
+        if not tags:
+            continue
+
+        if normalised:
+            nodes.append((osm_id, lat, lon, timestamp))
+            batch.extend((osm_id, k, v) for k, v in tags)
+        else:
+            batch.extend((osm_id, lat, lon, timestamp, k, v) for k, v in tags)
+
+        if len(batch) >= target_batch_size:
+            write_batch()
+
+    if batch:
+        write_batch()
+
+    return sum(size for _, size in blocks)
+
+
+def osm_to_csv(
+    processes: int | None = None,
+    blocks_per_task: int = 64,
+    target_batch_size: int = 1_000_000,
+    normalised: bool = False,
+    osm_filepath: str | None = None,
+    basepath: str | None = None,
+):
+    """
+    Converts all tagged nodes in the UK OSM extract into csv batch files in a
+    single pass over the file.
+    The data blocks of the PBF file are split into tasks of `blocks_per_task`
+    blocks which are handled by a pool of `processes` workers (defaults to the
+    number of cpus). Each worker writes its own batch files.
+    If `normalised`, the nodes and their tags are written to separate files
+    in `osm_normalised/` for `upload_osm_normalised`.
+    osm_filepath, basepath: convert another PBF file, or into another directory
+    """
+    if osm_filepath is None:
+        osm_filepath = download_osm()
+    if basepath is None:
+        basepath = get_download_path("osm_normalised/" if normalised else "osm/")
     try:
         os.makedirs(basepath)
     except OSError:
         return basepath
 
-    target_batch_size = 1_000_000
-    batch_no = 0
-    batch = []
-
-    # PERF:
-    # This is terrible - doing this just to find how many entries there are
-    entries_size = sum(
-        1
-        for _ in osmium.FileProcessor(osm_filepath, osmium.osm.NODE).with_filter(
-            osmium.filter.EmptyTagFilter()
+    blocks = get_pbf_blocks(osm_filepath)
+    header = next((offset, size) for t, offset, size in blocks if t == "OSMHeader")
+    data_blocks = [(offset, size) for t, offset, size in blocks if t == "OSMData"]
+
+    tasks = [
+        (
+            osm_filepath,
+            basepath,
+            header,
+            data_blocks[i : i + blocks_per_task],
+            task_no,
+            target_batch_size,
+            normalised,
         )
-    )
-
-    for i, obj in enumerate(
-        osmium.FileProcessor(osm_filepath, osmium.osm.NODE).with_filter(
-            osmium.filter.EmptyTagFilter()
-        )
-    ):
-        base_data = [
-            obj.id,
-            obj.lat,
-            obj.lon,
-            obj.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-        ]
-        for tag in obj.tags:
-            if tag.k == "source" or tag.k == "created_by":
-                continue
-            data = base_data + [tag.k, tag.v]
-            batch.append(data)
-
-        if len(batch) >= target_batch_size or i + 1 == entries_size:
+        for task_no, i in enumerate(range(0, len(data_blocks), blocks_per_task))
+    ]
+
+    total_bytes = os.path.getsize(osm_filepath)
+    bytes_read = header[1]
+    with multiprocessing.Pool(processes) as pool:
+        for size in pool.imap_unordered(_osm_blocks_to_csv, tasks):
+            bytes_read += size
             print(
-                f"writing batch {batch_no}. {i}/{entries_size}. {round(i/entries_size*100,2)}%"
+                f"processed {bytes_read}/{total_bytes} bytes. {round(bytes_read/total_bytes*100,2)}%"
             )
-            filepath = os.path.join(basepath, f"batch_{batch_no}.csv")
-
-            text = "\n".join(",".join(map(str, row)) for row in batch)
-
-            with open(filepath, "w") as f:
-                f.write(text)
-
-            batch.clear()
-            batch_no += 1
 
     return basepath
 
 
-def upload_osm(conn: pymysql.Connection, recreate=True):
+def upload_osm(
+    conn: pymysql.Connection,
+    recreate=True,
+    normalised=False,
+    pool: ConnectionPool | None = None,
+):
+    """
+    Uploads all tagged nodes into the `osm` table with one row per tag.
+    If `normalised`, the data is stored with `upload_osm_normalised` instead
+    and `osm` is a view over the normalised tables.
+    pool: load the batch files in parallel over the pooled connections. The
+        table is loaded without its AUTO_INCREMENT `id` column, which would
+        make the loads wait for each other's AUTO-INC lock, and the column
+        is added once all the files are loaded.
+    """
+    if normalised:
+        upload_osm_normalised(conn, recreate, pool)
+        return
+
     osm_basepath = osm_to_csv()
 
     paths = []
@@ -111,27 +294,182 @@ def upload_osm(conn: pymysql.Connection, recreate=True):
             ("lat", "decimal(11,8) NOT NULL"),
             ("lon", "decimal(10,8) NOT NULL"),
             ("timestamp", "date NOT NULL"),
-            ("key", "tinytext NOT NULL"),
-            ("value", "tinytext NOT NULL"),
+            ("key", "varchar(255) NOT NULL"),
+            ("value", "varchar(255) NOT NULL"),
+        ],
+        recreate=recreate,
+    )
+    config.upload(conn, pool)
+    get_backend(conn).add_row_ids("osm", "id")
+
+
+def _drop_table_or_view(conn: pymysql.Connection, name: str, views: bool = True):
+    """Drops `name` if it exists, unless it is a view and not `views`"""
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT table_type FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_name = "{name}"
+        """
+    )
+    row = cur.fetchone()
+    cur.close()
+    if row is not None and (views or row[0] != "VIEW"):
+        kind = "VIEW" if row[0] == "VIEW" else "TABLE"
+        execute_statement(conn, f"DROP {kind} `{name}`")
+
+
+def upload_osm_normalised(
+    conn: pymysql.Connection, recreate=True, pool: ConnectionPool | None = None
+):
+    """
+    Uploads all tagged nodes into
+        `osm_nodes`  (osm_id, lat, lon, timestamp) - one row per node
+        `osm_keys`   (id, key)
+        `osm_values` (id, value)
+        `osm_tags`   (id, osm_id, key_id, value_id) - one row per tag
+    and creates an `osm` view over them with the same columns as the
+    table created by `upload_osm`, so `create_subtables` and `get_osm_counts`
+    work unchanged. Only supported on MariaDB.
+    recreate: drop the tags and encode them all again. Otherwise only the
+        tags of files that were not loaded before are added.
+    """
+    if is_embedded(conn):
+        raise NotImplementedError("The normalised layout is only supported on MariaDB")
+
+    osm_basepath = osm_to_csv(normalised=True)
+
+    filenames = sorted(os.listdir(osm_basepath))
+    node_paths = [
+        os.path.join(osm_basepath, f) for f in filenames if f.startswith("nodes_")
+    ]
+    tag_paths = [
+        os.path.join(osm_basepath, f) for f in filenames if f.startswith("tags_")
+    ]
+
+    if recreate:
+        _drop_table_or_view(conn, "osm")
+        for table in ["osm_tags", "osm_keys", "osm_values", "osm_tags_raw"]:
+            execute_statement(conn, f"DROP TABLE IF EXISTS `{table}`")
+
+    UploadCsvConfig(
+        name="osm_nodes",
+        path=node_paths,
+        columns=[
+            ("osm_id", "bigint(20) unsigned NOT NULL PRIMARY KEY"),
+            ("lat", "decimal(11,8) NOT NULL"),
+            ("lon", "decimal(10,8) NOT NULL"),
+            ("timestamp", "date NOT NULL"),
         ],
-        primary_key="id",
         recreate=recreate,
+    ).upload(conn, pool)
+
+    # `osm_tags_raw` only holds the tags of files that are not dictionary
+    # encoded yet: it is emptied once they are, while the load registry keeps
+    # the files from being loaded again.
+    UploadCsvConfig(
+        name="osm_tags_raw",
+        path=tag_paths,
+        columns=[
+            ("osm_id", "bigint(20) unsigned NOT NULL"),
+            ("key", "varchar(255) NOT NULL"),
+            ("value", "varchar(255) NOT NULL"),
+        ],
+        recreate=False,
+    ).upload(conn, pool)
+
+    pending = bool(get_backend(conn).query("SELECT 1 FROM `osm_tags_raw` LIMIT 1"))
+
+    for table, column in [("osm_keys", "key"), ("osm_values", "value")]:
+        execute_statement(
+            conn,
+            f"""
+            CREATE TABLE IF NOT EXISTS `{table}` (
+            `id` int(10) unsigned NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            `{column}` varchar(255) NOT NULL,
+            UNIQUE KEY `{column}` (`{column}`)
+            ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+            """,
+        )
+        if pending:
+            execute_statement(
+                conn,
+                f"""
+                INSERT IGNORE INTO `{table}` (`{column}`)
+                SELECT DISTINCT `{column}` FROM `osm_tags_raw`
+                """,
+            )
+
+    execute_statement(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS `osm_tags` (
+        `id` bigint(20) unsigned NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        `osm_id` bigint(20) unsigned NOT NULL,
+        `key_id` int(10) unsigned NOT NULL,
+        `value_id` int(10) unsigned NOT NULL
+        ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+        """,
+    )
+    if pending:
+        # In one transaction, so the tags are never encoded twice.
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                """
+                INSERT INTO `osm_tags` (`osm_id`, `key_id`, `value_id`)
+                SELECT r.osm_id, k.id, v.id
+                FROM `osm_tags_raw` AS r
+                INNER JOIN `osm_keys` AS k ON r.key = k.key
+                INNER JOIN `osm_values` AS v ON r.value = v.value
+                """
+            )
+            cur.execute("DELETE FROM `osm_tags_raw`")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+    if not check_index_exists(conn, "osm_tags", "key_value"):
+        add_index(conn, "osm_tags", ["key_id", "value_id"], "key_value")
+    if not check_index_exists(conn, "osm_tags", "osm_id"):
+        add_index(conn, "osm_tags", "osm_id", "osm_id")
+
+    # Replaces the row per tag `osm` table of `upload_osm`, also without
+    # `recreate`, since the view can't be created while it exists.
+    _drop_table_or_view(conn, "osm", views=False)
+    execute_statement(
+        conn,
+        """
+        CREATE OR REPLACE VIEW `osm` AS
+        SELECT t.osm_id, n.lat, n.lon, n.timestamp, k.key, v.value, t.id
+        FROM `osm_tags` AS t
+        INNER JOIN `osm_nodes` AS n ON t.osm_id = n.osm_id
+        INNER JOIN `osm_keys` AS k ON t.key_id = k.id
+        INNER JOIN `osm_values` AS v ON t.value_id = v.id
+        """,
     )
-    config.upload(conn)
 
 
 def create_subtables(
     conn: pymysql.Connection,
     key: str | None = None,
     value: str | None = None,
+    spatial: bool = False,
 ):
     """
     Creates a table containing all entries from the `osm` table that
     match key = `key` and value = `value`.
+    If `spatial`, the table also gets a `location` POINT column with a
+    SPATIAL INDEX (added to an existing table if it is missing).
     """
+    created = False
     if key and value is None:
         table = get_table_name(key, value)
         if not check_table_exists(conn, table):
+            created = True
             create_separate_table(conn, "osm", table, {"key": key})
             add_index(conn, table, ["lat", "lon"], "coordinate")
             add_primary_key(conn, table, "id")
@@ -140,6 +478,7 @@ def create_subtables(
         base_table = get_table_name(key, None)
         table = get_table_name(key, value)
         if not check_table_exists(conn, table):
+            created = True
             # if not check_table_exists(conn, base_table):
 
             # Make sure the parent table exists
@@ -152,9 +491,97 @@ def create_subtables(
     else:
         raise ValueError(f"key: {key}, value: {value}")
 
+    if spatial:
+        _add_spatial_index_once(conn, table, created)
+
     return table
 
 
+# connection -> subtables that have their SPATIAL INDEX, so counting with
+# backend="spatial" doesn't check information_schema on every call.
+_SPATIAL_TABLES: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _add_spatial_index_once(conn, table: str, created: bool = False):
+    """`add_spatial_index` for the `location` of `table`, once per connection"""
+    prepared = _SPATIAL_TABLES.setdefault(conn, set())
+    if created:
+        prepared.discard(table)
+    if table not in prepared:
+        add_spatial_index(conn, table, "location")
+        prepared.add(table)
+
+
+def create_subtables_bulk(
+    conn: pymysql.Connection,
+    pairs: list[tuple[str, str | None]],
+    spatial: bool = False,
+) -> list[str]:
+    """
+    Same as calling `create_subtables` for every (key, value) in `pairs`
+    (value may be None), but the `osm` table is only scanned once.
+    All matching rows are copied into a temporary staging table, each
+    subtable is filled from that, and indexes are only added once all the
+    tables are loaded. Tables that already exist are not recreated.
+    Returns the table names in the order of `pairs`.
+    """
+    tables = [get_table_name(key, value) for key, value in pairs]
+    # The parent `osm_<key>_` table of every (key, value) pair is created too.
+    wanted = dict.fromkeys(
+        [*pairs, *((key, None) for key, value in pairs if value is not None)]
+    )
+    todo = {
+        get_table_name(key, value): (key, value)
+        for key, value in wanted
+        if not check_table_exists(conn, get_table_name(key, value))
+    }
+    if todo:
+        _fill_subtables(conn, todo)
+
+    if spatial:
+        # Also added to tables that already exist but don't have it.
+        for table in dict.fromkeys(tables):
+            _add_spatial_index_once(conn, table, table in todo)
+
+    return tables
+
+
+def _fill_subtables(conn, todo: dict[str, tuple[str, str | None]]):
+    """Creates the tables `todo` (table -> (key, value)) from one scan of `osm`"""
+    keys = sorted({key for key, value in todo.values() if value is None})
+    key_values = sorted(
+        {(key, value) for key, value in todo.values() if value is not None}
+    )
+    conditions = []
+    if keys:
+        in_keys = ", ".join(f"'{k}'" for k in keys)
+        conditions.append(f"`key` IN ({in_keys})")
+    if key_values:
+        in_pairs = ", ".join(f"('{k}', '{v}')" for k, v in key_values)
+        conditions.append(f"(`key`, `value`) IN ({in_pairs})")
+
+    db = get_backend(conn)
+    db.drop_temporary_table("osm_subtable_stage")
+    execute_statement(
+        conn,
+        f"""
+        CREATE TEMPORARY TABLE `osm_subtable_stage` AS
+        SELECT * FROM `osm`
+        WHERE {" OR ".join(conditions)}
+        """,
+    )
+
+    for table, (key, value) in todo.items():
+        select = {"key": key} if value is None else {"key": key, "value": value}
+        create_separate_table(conn, "osm_subtable_stage", table, select)
+
+    db.drop_temporary_table("osm_subtable_stage")
+
+    for table in todo:
+        add_index(conn, table, ["lat", "lon"], "coordinate")
+        add_primary_key(conn, table, "id")
+
+
 def get_table_name(key, value):
     if key is not None and value is not None:
         return f"osm_{key}_{value}"
@@ -164,16 +591,68 @@ def get_table_name(key, value):
         raise ValueError(f"key: {key}, value: {value} is not valid")
 
 
+# connection -> (key, value) -> (subtable versions, index). Other connections
+# never share an index, and a changed subtable is loaded again.
+_OSM_INDEXES: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_osm_index(
+    conn: pymysql.Connection,
+    key: str | None = None,
+    value: str | None = None,
+    reload: bool = False,
+) -> BoxCountIndex:
+    """
+    Loads the `osm_<key>_<value>` subtable into an in memory `BoxCountIndex`.
+    The index is kept for `conn` and only loaded again if the subtable
+    changed (see `get_table_versions`) or if `reload`.
+    """
+    table = get_table_name(key, value)
+    indexes = _OSM_INDEXES.setdefault(conn, {})
+    versions = get_table_versions(conn, [table])
+    cached = indexes.get((key, value))
+    if reload or not versions or cached is None or cached[0] != versions:
+        create_subtables(conn, key, value)
+        df = pd.read_sql(f"SELECT lat, lon FROM `{table}`", conn)
+        index = BoxCountIndex(df.lat, df.lon)
+        indexes[(key, value)] = (get_table_versions(conn, [table]), index)
+    return indexes[(key, value)][1]
+
+
 def get_osm_counts(
     conn: pymysql.Connection,
     key: str | None = None,
     value: str | None = None,
     coords: tuple[float, float, float, float] | None = None,
+    backend: str = "sql",
 ):
-    table = create_subtables(conn, key, value)
+    """
+    backend: "sql" counts with a query against the subtable, "spatial" does
+        the same with MBRContains on the subtable's SPATIAL INDEX and "memory"
+        counts with the index from `get_osm_index`, which only checks the
+        version of the subtable with the database.
+    """
+    if backend == "memory":
+        index = get_osm_index(conn, key, value)
+        if coords is None:
+            return len(index)
+        return int(index.count([coords])[0])
+    elif backend not in ("sql", "spatial"):
+        raise ValueError(f"Unknown backend: {backend}")
+
+    table = create_subtables(conn, key, value, spatial=backend == "spatial")
     # table = get_table_name(key, value)
 
-    if coords is not None:
+    if coords is not None and backend == "spatial":
+        n, w, s, e = coords
+
+        statement = f"""
+        SELECT count(*) FROM `{table}`
+        WHERE MBRContains(
+            ST_Envelope(LineString(Point({w}, {n}), Point({e}, {s}))), location
+        )
+        """
+    elif coords is not None:
         n, w, s, e = coords
 
         statement = f"""
@@ -191,6 +670,290 @@ def get_osm_counts(
     return cur.fetchone()[0]
 
 
+def get_osm_counts_batched(
+    conn: pymysql.Connection,
+    key: str | None,
+    value: str | None,
+    coords: list[tuple[float, float, float, float]],
+    backend: str = "sql",
+) -> np.ndarray:
+    """
+    Same as calling `get_osm_counts` for every box in `coords`, but the boxes
+    are uploaded to a temporary table and counted with a single join.
+    With backend="memory" all boxes are counted against `get_osm_index`.
+    """
+    if backend == "memory":
+        return get_osm_index(conn, key, value).count(coords)
+    elif backend not in ("sql", "spatial"):
+        raise ValueError(f"Unknown backend: {backend}")
+
+    table = create_subtables(conn, key, value, spatial=backend == "spatial")
+    db = _create_count_boxes(conn, coords)
+
+    statement = f"""
+    SELECT b.idx, count(o.lat) FROM `osm_count_boxes` AS b
+    LEFT JOIN `{table}` AS o
+        ON {_box_condition(backend)}
+    GROUP BY b.idx
+    """
+    echo(statement)
+
+    counts = np.zeros(len(coords), dtype=np.int64)
+    for idx, count in db.query(statement):
+        counts[idx] = count
+
+    db.drop_temporary_table("osm_count_boxes")
+    return counts
+
+
+def _create_count_boxes(conn, coords, inner=()):
+    """
+    Uploads `coords` to the temporary table `osm_count_boxes`. Each (N, 4)
+    array of boxes in `inner` is added as the columns min_lat_i, min_lon_i,
+    max_lat_i and max_lon_i.
+    """
+    db = get_backend(conn)
+    bounds = ["min_lat", "min_lon", "max_lat", "max_lon"]
+    columns = [("idx", "bigint NOT NULL PRIMARY KEY")]
+    columns += [(column, "double NOT NULL") for column in bounds]
+    columns += [
+        (f"{column}_{i}", "double NOT NULL")
+        for i in range(len(inner))
+        for column in bounds
+    ]
+    db.create_temporary_table("osm_count_boxes", columns)
+
+    boxes = np.hstack(
+        [np.asarray(c, dtype=np.float64).reshape(-1, 4) for c in [coords, *inner]]
+    )
+    params = ", ".join([db.param] * len(columns))
+    db.executemany(
+        f"INSERT INTO `osm_count_boxes` VALUES ({params})",
+        [(i, *box) for i, box in enumerate(boxes.tolist())],
+    )
+    return db
+
+
+def _box_condition(backend: str) -> str:
+    """Join condition between the boxes `b` and the subtable `o`"""
+    if backend == "spatial":
+        return """MBRContains(
+            ST_Envelope(
+                LineString(Point(b.min_lon, b.min_lat), Point(b.max_lon, b.max_lat))
+            ),
+            o.location
+        )"""
+    return """o.lat BETWEEN b.min_lat AND b.max_lat
+        AND o.lon BETWEEN b.min_lon AND b.max_lon"""
+
+
+def get_osm_candidates(
+    conn: pymysql.Connection,
+    key: str | None,
+    value: str | None,
+    coords: list[tuple[float, float, float, float]],
+    backend: str = "sql",
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns (box, lat, lon) for every point of the subtable inside each box
+    in `coords`, where box is the position of the box in `coords`.
+    backend: as for `get_osm_counts_batched`
+    """
+    if backend == "memory":
+        return get_osm_index(conn, key, value).candidates(coords)
+    elif backend not in ("sql", "spatial"):
+        raise ValueError(f"Unknown backend: {backend}")
+
+    table = create_subtables(conn, key, value, spatial=backend == "spatial")
+    db = _create_count_boxes(conn, coords)
+
+    statement = f"""
+    SELECT b.idx, o.lat, o.lon FROM `osm_count_boxes` AS b
+    INNER JOIN `{table}` AS o
+        ON {_box_condition(backend)}
+    """
+    echo(statement)
+    rows = db.query(statement)
+    db.drop_temporary_table("osm_count_boxes")
+
+    if not rows:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, np.zeros(0), np.zeros(0)
+    idx, lats, lons = zip(*rows)
+    return (
+        np.array(idx, dtype=np.int64),
+        np.array(lats, dtype=np.float64),
+        np.array(lons, dtype=np.float64),
+    )
+
+
+def get_osm_tag_counts(
+    conn: pymysql.Connection,
+    tags: dict[str, bool | str | list[str]],
+    coords,
+    backend: str = "sql",
+) -> pd.DataFrame:
+    """
+    Counts the nodes matching each tag of an osmnx style `tags` dict (e.g.
+    {"amenity": True, "shop": ["bakery", "butcher"]}) in every box of
+    `coords`, returning an (N, len(tags)) DataFrame with one column per tag.
+    With backend="sql" all tags and boxes are counted with one query over
+    the `osm_<key>_` subtables, with "memory" against `get_osm_index`.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+    # key -> the wanted values, or None for any value
+    wanted = {}
+    for key, values in tags.items():
+        if values is True:
+            wanted[key] = None
+        else:
+            wanted[key] = [values] if isinstance(values, str) else list(values)
+
+    counts = pd.DataFrame(
+        0, index=range(len(coords)), columns=list(tags), dtype=np.int64
+    )
+    if not len(coords) or not tags:
+        return counts
+
+    if backend == "memory":
+        for key, values in wanted.items():
+            for value in [None] if values is None else values:
+                counts[key] += get_osm_index(conn, key, value).count(coords)
+        return counts
+    elif backend != "sql":
+        raise ValueError(f"Unknown backend: {backend}")
+
+    tables = create_subtables_bulk(conn, [(key, None) for key in wanted])
+    db = _create_count_boxes(conn, coords)
+
+    selects = []
+    for (key, values), table in zip(wanted.items(), tables):
+        condition = _box_condition(backend)
+        if values is not None:
+            in_values = ", ".join(f"'{v}'" for v in values)
+            condition = f"{condition} AND o.`value` IN ({in_values})"
+        selects.append(
+            f"""
+            SELECT b.idx, '{key}' AS tag, count(*) FROM `osm_count_boxes` AS b
+            INNER JOIN `{table}` AS o ON {condition}
+            GROUP BY b.idx
+            """
+        )
+    statement = "\nUNION ALL\n".join(selects)
+    echo(statement)
+
+    for idx, key, count in db.query(statement):
+        counts.at[idx, key] = count
+
+    db.drop_temporary_table("osm_count_boxes")
+    return counts
+
+
+# The radius used by `haversine.haversine`
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Element-wise haversine distance in km between two sets of points"""
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def get_osm_counts_multi(
+    conn: pymysql.Connection,
+    key: str | None,
+    value: str | None,
+    lats,
+    lons,
+    distances: list[float],
+    haversine: bool = False,
+    backend: str = "sql",
+) -> np.ndarray:
+    """
+    Counts the points of the subtable near every (lat, lon) for all
+    `distances` at once, returning an (N, len(distances)) array.
+    Boxes of every distance are counted in one query that only returns the
+    counts. With `haversine` the candidates are fetched once, for the
+    largest distance, and every distance is counted from them.
+    haversine: count the points within `distance` km of each point. By
+        default the points in `get_box_coords(lat, lon, distance)` are
+        counted, the same as `get_osm_counts`.
+    backend: as for `get_osm_counts_batched`
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    distances = list(distances)
+    counts = np.zeros((len(lats), len(distances)), dtype=np.int64)
+    if not len(lats) or not distances:
+        return counts
+
+    if not haversine:
+        boxes = [get_box_coords_array(lats, lons, distance) for distance in distances]
+        if backend == "memory":
+            index = get_osm_index(conn, key, value)
+            for i, coords in enumerate(boxes):
+                counts[:, i] = index.count(coords)
+            return counts
+        return _count_boxes_multi(conn, key, value, boxes, backend)
+
+    # A box of side 2r contains the circle of radius r. The margin covers
+    # the difference between the spherical and ellipsoidal distances.
+    coords = get_box_coords_array(lats, lons, max(distances) * 2.02)
+    idx, cand_lats, cand_lons = get_osm_candidates(conn, key, value, coords, backend)
+
+    dist = haversine_km(lats[idx], lons[idx], cand_lats, cand_lons)
+    for i, distance in enumerate(distances):
+        counts[:, i] = np.bincount(idx[dist <= distance], minlength=len(lats))
+    return counts
+
+
+def _count_boxes_multi(conn, key, value, boxes: list[np.ndarray], backend: str):
+    """
+    Counts the points in each of the boxes of every array in `boxes` with a
+    single join on the largest boxes, so only the counts are fetched.
+    """
+    if backend not in ("sql", "spatial"):
+        raise ValueError(f"Unknown backend: {backend}")
+
+    table = create_subtables(conn, key, value, spatial=backend == "spatial")
+    outer = np.stack(
+        [
+            np.minimum.reduce([b[:, 0] for b in boxes]),
+            np.minimum.reduce([b[:, 1] for b in boxes]),
+            np.maximum.reduce([b[:, 2] for b in boxes]),
+            np.maximum.reduce([b[:, 3] for b in boxes]),
+        ],
+        axis=1,
+    )
+    db = _create_count_boxes(conn, outer, boxes)
+
+    sums = ",\n".join(
+        f"""SUM(CASE WHEN o.lat BETWEEN b.min_lat_{i} AND b.max_lat_{i}
+            AND o.lon BETWEEN b.min_lon_{i} AND b.max_lon_{i} THEN 1 ELSE 0 END)"""
+        for i in range(len(boxes))
+    )
+    statement = f"""
+    SELECT b.idx, {sums}
+    FROM `osm_count_boxes` AS b
+    LEFT JOIN `{table}` AS o
+        ON {_box_condition(backend)}
+    GROUP BY b.idx
+    """
+    echo(statement)
+
+    counts = np.zeros((len(outer), len(boxes)), dtype=np.int64)
+    for idx, *row in db.query(statement):
+        counts[idx] = row
+    db.drop_temporary_table("osm_count_boxes")
+    return counts
+
+
 def load_subtable_df(conn, key, value) -> pd.DataFrame:
     table = get_table_name(key, value)
     # # statement = f"""
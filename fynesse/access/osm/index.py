@@ -0,0 +1,153 @@
+import numpy as np
+
+
+# Offset between latitude strips in the sorted key array. Must be larger than
+# the range of shifted longitudes (0 to 360 degrees) plus some margin.
+_STRIP_SPAN = 512.0
+# Keys are only used to find candidates, which are then checked exactly.
+_KEY_EPS = 1e-6
+
+
+def _ragged_arange(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Concatenation of arange(s, s + l) for every s, l in zip(starts, lengths)"""
+    total = lengths.sum()
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.arange(total) - offsets + np.repeat(starts, lengths)
+
+
+class BoxCountIndex:
+    """
+    In memory sorted grid for counting points inside bounding boxes.
+
+    Points are split into latitude strips of `strip_height` degrees and are
+    sorted by longitude within each strip. A box query only has to look at
+    the longitude range of the strips it touches, and all queries are
+    answered together with vectorised `searchsorted` calls.
+
+    Boxes are (min_lat, min_lon, max_lat, max_lon) like `get_box_coords`,
+    and both bounds are inclusive like the SQL `BETWEEN` in `get_osm_counts`.
+    """
+
+    def __init__(self, lats, lons, strip_height: float = 0.01):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+
+        self.strip_height = strip_height
+        self.origin = lats.min() if len(lats) else 0.0
+        strips = self._strip(lats)
+        self.n_strips = int(strips.max()) + 1 if len(lats) else 0
+
+        keys = strips * _STRIP_SPAN + (lons + 180.0)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.lats = lats[order]
+        self.lons = lons[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _strip(self, lats: np.ndarray) -> np.ndarray:
+        return np.floor((lats - self.origin) / self.strip_height).astype(np.int64)
+
+    def count(self, coords, chunk_size: int = 4096) -> np.ndarray:
+        """Returns the number of points in each of the (N, 4) boxes in `coords`"""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+        counts = np.zeros(len(coords), dtype=np.int64)
+        if not len(self) or not len(coords):
+            return counts
+
+        for start in range(0, len(coords), chunk_size):
+            chunk = coords[start : start + chunk_size]
+            counts[start : start + len(chunk)] = self._count(chunk)
+        return counts
+
+    def candidates(self, coords) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns (box, lat, lon) for every point in each of the (N, 4) boxes in
+        `coords`, where box is the position of the box in `coords`.
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+        if not len(self) or not len(coords):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, np.zeros(0), np.zeros(0)
+
+        query, points = self._candidates(coords)
+        return query, self.lats[points], self.lons[points]
+
+    def _pairs(self, coords: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (query, strip, interior) for every strip touched by every box, where
+        interior is True if all points of the strip are inside the box in
+        latitude.
+        """
+        first = self._strip(coords[:, 0])
+        last = self._strip(coords[:, 2])
+        clipped = np.clip(first, 0, self.n_strips - 1)
+        n_strips = np.maximum(np.clip(last, 0, self.n_strips - 1) - clipped + 1, 0)
+
+        query = np.repeat(np.arange(len(coords)), n_strips)
+        strip = _ragged_arange(clipped, n_strips)
+        # floor is monotonic, so a strip strictly between the strips of the
+        # bounds only holds latitudes strictly between them.
+        interior = (strip > first[query]) & (strip < last[query])
+        return query, strip, interior
+
+    def _search(self, strip, lon, eps: float, side: str) -> np.ndarray:
+        return np.searchsorted(
+            self.keys, strip * _STRIP_SPAN + (lon + 180.0 + eps), side=side
+        )
+
+    def _inside(self, coords: np.ndarray, query, points) -> np.ndarray:
+        lats = self.lats[points]
+        lons = self.lons[points]
+        return (
+            (lats >= coords[query, 0])
+            & (lats <= coords[query, 2])
+            & (lons >= coords[query, 1])
+            & (lons <= coords[query, 3])
+        )
+
+    def _count(self, coords: np.ndarray) -> np.ndarray:
+        """
+        Counts without listing the points: in interior strips the points away
+        from the longitude bounds are counted from their positions, and only
+        the points near the bounds and those of the first and last strip of
+        each box are checked one by one.
+        """
+        query, strip, interior = self._pairs(coords)
+        min_lon = coords[query, 1]
+        max_lon = coords[query, 3]
+
+        lo = self._search(strip, min_lon, -_KEY_EPS, "left")
+        hi = self._search(strip, max_lon, _KEY_EPS, "right")
+        # Keys in lo_inner:hi_inner are more than _KEY_EPS inside the bounds.
+        lo_inner = self._search(strip, min_lon, _KEY_EPS, "right")
+        hi_inner = self._search(strip, max_lon, -_KEY_EPS, "left")
+
+        bulk = interior & (lo_inner < hi_inner)
+        counts = np.bincount(
+            query[bulk], weights=hi_inner[bulk] - lo_inner[bulk], minlength=len(coords)
+        ).astype(np.int64)
+
+        starts = np.concatenate([lo[bulk], hi_inner[bulk], lo[~bulk]])
+        stops = np.concatenate([lo_inner[bulk], hi[bulk], hi[~bulk]])
+        owners = np.concatenate([query[bulk], query[bulk], query[~bulk]])
+        lengths = np.maximum(stops - starts, 0)
+
+        points = _ragged_arange(starts, lengths)
+        owners = np.repeat(owners, lengths)
+        inside = self._inside(coords, owners, points)
+        counts += np.bincount(owners[inside], minlength=len(coords))
+        return counts
+
+    def _candidates(self, coords: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """(query, point) position pairs of the points inside each box"""
+        query, strip, _ = self._pairs(coords)
+        lo = self._search(strip, coords[query, 1], -_KEY_EPS, "left")
+        hi = self._search(strip, coords[query, 3], _KEY_EPS, "right")
+        lengths = np.maximum(hi - lo, 0)
+
+        candidates = _ragged_arange(lo, lengths)
+        query = np.repeat(query, lengths)
+        inside = self._inside(coords, query, candidates)
+        return query[inside], candidates[inside]
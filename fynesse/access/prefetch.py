@@ -0,0 +1,113 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from fynesse.access.census import download_census_data_2021
+from fynesse.access.election import (
+    download_constituency_geolocation,
+    download_election,
+    download_election_historical,
+    download_msoa_2021_to_constituency_2024,
+)
+from fynesse.access.oa_boundary.download import download_2021_oa_boundaries
+from fynesse.access.osm.download import download_osm
+from fynesse.access.utils import set_download_progress
+
+
+DATASETS: dict[str, Callable[[], str]] = {
+    "oa_boundaries_2021": download_2021_oa_boundaries,
+    "msoa_2021_to_constituency_2024": download_msoa_2021_to_constituency_2024,
+    "constituency_geolocation": download_constituency_geolocation,
+    "election_historical": download_election_historical,
+    "osm": download_osm,
+}
+
+
+def get_dataset_downloader(name: str) -> Callable[[], str]:
+    """
+    Returns the download function for a dataset name. Besides the names in
+    `DATASETS`, "census2021-<code>" and "election-<year>" are accepted.
+    """
+    if name in DATASETS:
+        return DATASETS[name]
+    if name.startswith("census2021-"):
+        code = name.removeprefix("census2021-")
+        return lambda: download_census_data_2021(code)
+    if name.startswith("election-"):
+        year = int(name.removeprefix("election-"))
+        return lambda: download_election(year)
+    raise ValueError(f"Unknown dataset: {name}")
+
+
+class _Progress:
+    """Thread safe per-dataset progress, printed at most every `interval` seconds"""
+
+    def __init__(self, names: list[str], interval: float):
+        self.interval = interval
+        self.status = {name: "pending" for name in names}
+        self._lock = threading.Lock()
+        self._last_print = 0.0
+
+    def update(self, name: str, status: str, force: bool = False):
+        with self._lock:
+            self.status[name] = status
+            now = time.monotonic()
+            if force or now - self._last_print >= self.interval:
+                self._last_print = now
+                print(" | ".join(f"{n}: {s}" for n, s in self.status.items()))
+
+    def callback(self, name: str) -> Callable[[int, int | None], None]:
+        def report(done: int, total: int | None):
+            if total:
+                status = f"{done / 2**20:.1f}/{total / 2**20:.1f}MB {done / total:.0%}"
+            else:
+                status = f"{done / 2**20:.1f}MB"
+            self.update(name, status)
+
+        return report
+
+
+def prefetch(
+    manifest: list[str | tuple[str, Callable[[], str]]],
+    max_downloads: int = 4,
+    interval: float = 5.0,
+) -> dict[str, str]:
+    """
+    Downloads every dataset in `manifest` concurrently, with at most
+    `max_downloads` running at once. Entries are dataset names (see
+    `get_dataset_downloader`) or (name, download function) pairs. The
+    existing download functions are used, so files end up at the usual
+    `get_download_path` locations.
+    Returns {name: path}. Raises after all downloads finish if any failed.
+    """
+    jobs = []
+    for entry in manifest:
+        if isinstance(entry, str):
+            jobs.append((entry, get_dataset_downloader(entry)))
+        else:
+            jobs.append(entry)
+
+    progress = _Progress([name for name, _ in jobs], interval)
+
+    def run(job):
+        name, download = job
+        progress.update(name, "downloading")
+        set_download_progress(progress.callback(name))
+        try:
+            path = download()
+        except Exception as e:
+            progress.update(name, f"failed ({e})", force=True)
+            return name, None, e
+        finally:
+            set_download_progress(None)
+        progress.update(name, "done", force=True)
+        return name, path, None
+
+    with ThreadPoolExecutor(max_workers=max_downloads) as executor:
+        results = list(executor.map(run, jobs))
+
+    failed = {name: error for name, _, error in results if error is not None}
+    if failed:
+        raise Exception(f"Failed to download: {failed}")
+    return {name: path for name, path, _ in results}
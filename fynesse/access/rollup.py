@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from fynesse.access.utils import get_download_path, get_table_versions, read_sql
+
+
+# (source level, target level) -> (lookup table, source column, target column,
+# weight column). A weight column gives the fraction of each source area that
+# lies in the target area; without one every source area counts fully.
+ROLLUP_LOOKUPS: dict[tuple[str, str], tuple[str, str, str, str | None]] = {
+    ("msoa", "constituency"): (
+        "msoa_2021_to_constituency_2024",
+        "MSOA21CD",
+        "PCON25CD",
+        None,
+    ),
+    ("oa", "constituency"): (
+        "oa_2021_to_constituency_2024",
+        "OA21CD",
+        "PCON25CD",
+        None,
+    ),
+}
+
+
+def get_rollup_cache_path() -> str:
+    return get_download_path("rollup/")
+
+
+class RollUp:
+    """
+    Sparse (targets x sources) matrix that sums values of source areas into
+    the target areas that contain them, e.g. MSOAs into constituencies.
+    `matrix[i, j]` is the weight of `sources[j]` in `targets[i]`.
+    """
+
+    def __init__(self, matrix: sp.csr_matrix, sources, targets):
+        self.matrix = sp.csr_matrix(matrix)
+        self.sources = np.asarray(sources)
+        self.targets = np.asarray(targets)
+        self._positions = pd.Index(self.sources)
+
+    @classmethod
+    def from_lookup(
+        cls,
+        sources,
+        targets,
+        weights=None,
+    ) -> "RollUp":
+        """
+        Builds the matrix from the rows of a lookup table, one per
+        (source, target) pair. Repeated pairs are summed.
+        """
+        source_codes, source_idx = np.unique(np.asarray(sources), return_inverse=True)
+        target_codes, target_idx = np.unique(np.asarray(targets), return_inverse=True)
+        if weights is None:
+            weights = np.ones(len(source_idx))
+
+        matrix = sp.csr_matrix(
+            (np.asarray(weights, dtype=np.float64), (target_idx, source_idx)),
+            shape=(len(target_codes), len(source_codes)),
+        )
+        matrix.sum_duplicates()
+        return cls(matrix, source_codes, target_codes)
+
+    def __repr__(self):
+        return (
+            f"RollUp({len(self.sources)} sources -> {len(self.targets)} targets, "
+            f"{self.matrix.nnz} entries)"
+        )
+
+    def _columns(self, codes) -> sp.csr_matrix:
+        """The columns of `matrix` for `codes`, zero for unknown codes"""
+        positions = self._positions.get_indexer(np.asarray(codes))
+        known = positions >= 0
+        select = sp.csr_matrix(
+            (
+                np.ones(known.sum()),
+                (positions[known], np.flatnonzero(known)),
+            ),
+            shape=(len(self.sources), len(codes)),
+        )
+        return self.matrix @ select
+
+    def apply(self, values, codes=None) -> np.ndarray:
+        """
+        Rolls up the (len(codes), ...) array `values` whose rows are the
+        source areas `codes` (`sources` by default) into a (len(targets), ...)
+        array. Several census tables can be stacked along the columns and
+        rolled up together. Rows of areas not in the lookup are ignored.
+        """
+        values = np.asarray(values)
+        flat = values.reshape(len(values), -1)
+        matrix = self.matrix if codes is None else self._columns(codes)
+        out = np.asarray(matrix @ flat)
+        return out.reshape((len(self.targets),) + values.shape[1:])
+
+    def apply_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        """`apply` to a DataFrame indexed by source code, indexed by target"""
+        return pd.DataFrame(
+            self.apply(df.to_numpy(dtype=np.float64), df.index),
+            index=self.targets,
+            columns=df.columns,
+        )
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            shape=np.array(self.matrix.shape),
+            sources=self.sources.astype(str),
+            targets=self.targets.astype(str),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "RollUp":
+        with np.load(path) as f:
+            matrix = sp.csr_matrix(
+                (f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"])
+            )
+            return cls(matrix, f["sources"], f["targets"])
+
+
+def load_rollup(
+    conn, source: str = "msoa", target: str = "constituency", reload: bool = False
+) -> RollUp:
+    """
+    The `RollUp` from `source` to `target` built from the lookup table in
+    `ROLLUP_LOOKUPS`. It is cached in `get_rollup_cache_path()` and rebuilt
+    when the lookup table changes or if `reload`.
+    """
+    table, source_column, target_column, weight_column = ROLLUP_LOOKUPS[
+        (source, target)
+    ]
+
+    key = json.dumps(
+        [
+            str(getattr(conn, "host", "")),
+            str(getattr(conn, "db", "")),
+            ROLLUP_LOOKUPS[(source, target)],
+            get_table_versions(conn, [table]),
+        ]
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    cache_dir = get_rollup_cache_path()
+    path = os.path.join(cache_dir, f"{source}_{target}_{digest[:16]}.npz")
+
+    if os.path.exists(path) and not reload:
+        return RollUp.load(path)
+
+    columns = [source_column, target_column] + (
+        [weight_column] if weight_column else []
+    )
+    statement = f"SELECT {', '.join(f'`{c}`' for c in columns)} FROM `{table}`"
+    df = read_sql(statement, conn, [table])
+
+    rollup = RollUp.from_lookup(
+        df[source_column],
+        df[target_column],
+        df[weight_column] if weight_column else None,
+    )
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Older versions of the same roll-up are stale now.
+    for name in os.listdir(cache_dir):
+        if name.startswith(f"{source}_{target}_"):
+            os.remove(os.path.join(cache_dir, name))
+    rollup.save(path)
+    return rollup
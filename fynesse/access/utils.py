@@ -1,13 +1,31 @@
-import io
+import csv
+import hashlib
+import json
+import math
 import pandas as pd
 import os
+import queue
+import re
+import shutil
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
+from typing import Any, Callable
 
 import pymysql
 import pymysql.cursors
 import requests
 
+from fynesse.access.backend import (
+    create_embedded_connection,
+    get_backend,
+    is_embedded,
+)
+from fynesse.access.instrument import InstrumentedMySQLCursor, track
+from fynesse.config import config
+
 
 """
 TODO:
@@ -19,7 +37,51 @@ def get_download_path(relative_path: str) -> str:
     return os.path.join("./downloads/", relative_path)
 
 
-def download_file(url: str, path: str = "") -> str:
+# Set per thread by `set_download_progress`, used by `prefetch`.
+_download_progress = threading.local()
+
+
+def set_download_progress(callback: Callable[[int, int | None], None] | None):
+    """
+    Registers a callback for `download_file` calls made from the current
+    thread. It is called with (bytes downloaded, total bytes or None).
+    """
+    _download_progress.callback = callback
+
+
+def _file_hash(path: str, algorithm: str) -> str:
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _response_validator(response) -> str | None:
+    """A strong ETag, or else the Last-Modified date, of `response` for If-Range"""
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def download_file(
+    url: str,
+    path: str = "",
+    checksum: str | None = None,
+    retries: int = 3,
+    chunk_size: int = 1 << 20,
+) -> str:
+    """
+    Streams `url` to `path` in chunks via a `<path>.part` file, which is
+    renamed into place once complete. An interrupted download is resumed
+    with a Range request, both on retries and on later calls. The resumed
+    part is only used if the file is unchanged, checked with If-Range
+    against the ETag or Last-Modified of the first response, otherwise the
+    download starts again.
+    checksum: optional "<algorithm>:<hexdigest>" (e.g. "sha256:ab12...")
+        the download must match
+    """
     if not path:
         path = get_download_path(os.path.basename(url))
 
@@ -27,32 +89,144 @@ def download_file(url: str, path: str = "") -> str:
         print(f"Files already exist at: {path}.")
         return path
 
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    part_path = f"{path}.part"
+    # ETag or Last-Modified of the response the partial file came from
+    validator_path = f"{path}.part.validator"
+
+    def restart():
+        for stale in (part_path, validator_path):
+            if os.path.exists(stale):
+                os.remove(stale)
+
     print(f"Downloading to {path}")
-    response = requests.get(url)
-    if response.status_code == 200:
-        with open(path, "wb") as file:
-            file.write(response.content)
-        return path
-    else:
+    complete = False
+    with track("download", url) as record:
+        for attempt in range(retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            validator = None
+            if os.path.exists(validator_path):
+                with open(validator_path) as f:
+                    validator = f.read()
+            if offset and validator is None:
+                # Nothing to tell whether the file changed since, e.g. the
+                # daily OSM extract, so the partial file can't be trusted.
+                restart()
+                offset = 0
+            # If-Range makes the server send the whole file (200) instead of
+            # the rest if it changed since the partial file was written.
+            headers = {}
+            if offset:
+                headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+            try:
+                with requests.get(
+                    url, headers=headers, stream=True, timeout=60
+                ) as response:
+                    if response.status_code == 416:
+                        # The partial file is complete if it has the full size.
+                        content_range = response.headers.get("Content-Range", "")
+                        if content_range == f"bytes */{offset}":
+                            complete = True
+                            break
+                        restart()
+                        continue
+                    if response.status_code not in (200, 206):
+                        raise Exception(f"Unable to download: {url}")
+                    if response.status_code == 206 and not response.headers.get(
+                        "Content-Range", ""
+                    ).startswith(f"bytes {offset}-"):
+                        restart()
+                        continue
+                    # A 200 means the server ignored the range or the file
+                    # changed, so start again.
+                    if response.status_code == 200:
+                        offset = 0
+                        validator = _response_validator(response)
+                        restart()
+                        if validator is not None:
+                            with open(validator_path, "w") as f:
+                                f.write(validator)
+                    mode = "ab" if offset else "wb"
+                    length = response.headers.get("Content-Length")
+                    total = offset + int(length) if length is not None else None
+
+                    callback = getattr(_download_progress, "callback", None)
+                    with open(part_path, mode) as file:
+                        for chunk in response.iter_content(chunk_size):
+                            file.write(chunk)
+                            offset += len(chunk)
+                            if record is not None:
+                                record.bytes += len(chunk)
+                            if callback is not None:
+                                callback(offset, total)
+                complete = True
+                break
+            except requests.RequestException as e:
+                if attempt == retries:
+                    raise
+                print(f"Download interrupted ({e}), resuming")
+
+    if not complete:
+        restart()
         raise Exception(f"Unable to download: {url}")
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+
+    if checksum is not None:
+        algorithm, expected = checksum.split(":", 1)
+        actual = _file_hash(part_path, algorithm)
+        if actual != expected.lower():
+            os.remove(part_path)
+            raise Exception(
+                f"Checksum mismatch for {url}: expected {expected}, got {actual}"
+            )
+
+    os.replace(part_path, path)
+    return path
 
 
-def download_zip(url: str, path: str) -> str:
+def download_zip(url: str, path: str, checksum: str | None = None) -> str:
+    """
+    Downloads the archive at `url` with `download_file` and extracts it into
+    the directory `path`.
+    """
     if os.path.exists(path) and os.listdir(path):
         print(f"Files already exist at: {path}.")
         return path
 
-    os.makedirs(path, exist_ok=True)
-    response = requests.get(url)
-    response.raise_for_status()
+    zip_path = download_file(url, f"{os.path.normpath(path)}.zip", checksum)
 
-    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
-        zip_ref.extractall(path)
+    # Extract next to the target so a partial extraction is never mistaken
+    # for a complete one.
+    tmp_path = f"{os.path.normpath(path)}.extracting"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        zip_ref.extractall(tmp_path)
+
+    if os.path.isdir(path):
+        os.rmdir(path)
+    os.replace(tmp_path, path)
+    os.remove(zip_path)
 
     print(f"Files extracted to: {path}")
     return path
 
 
+def connect(user=None, password=None, host=None, database=None, port=3306):
+    """
+    Connects to the database selected by `database_backend` in the config:
+    "mariadb" (the default) uses `create_connection` with the arguments, and
+    "sqlite" opens the embedded database at `sqlite_path` instead.
+    """
+    backend = config.get("database_backend", "mariadb")
+    if backend == "sqlite":
+        return create_embedded_connection(config["sqlite_path"])
+    elif backend == "mariadb":
+        return create_connection(user, password, host, database, port)
+    raise ValueError(f"Unknown database_backend: {backend}")
+
+
 def create_connection(user, password, host, database, port=3306):
     """Create a database connection to the MariaDB database
         specified by the host url and database name.
@@ -71,6 +245,7 @@ def create_connection(user, password, host, database, port=3306):
             port=port,
             local_infile=1,
             db=database,
+            cursorclass=InstrumentedMySQLCursor,
         )
         print("Connection established!")
     except Exception as e:
@@ -79,128 +254,565 @@ def create_connection(user, password, host, database, port=3306):
     return conn
 
 
+class ConnectionPool:
+    """
+    A fixed size pool of connections created with `create_connection`.
+    Connections are only opened when they are first needed.
+
+        with ConnectionPool(user, password, host, database, size=8) as pool:
+            with pool.connection() as conn:
+                ...
+    """
+
+    def __init__(self, user, password, host, database, port=3306, size: int = 4):
+        self.size = size
+        self._args = (user, password, host, database, port)
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> pymysql.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = create_connection(*self._args)
+                self._all.append(conn)
+                return conn
+
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            conn.ping(reconnect=True)
+            yield conn
+        except BaseException:
+            # Don't leave the failed transaction open for the next user, who
+            # could commit it.
+            try:
+                conn.rollback()
+            except pymysql.Error:
+                # A broken connection is reconnected by `ping` when reused.
+                pass
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+            self._idle = queue.LifoQueue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_parallel(
+    pool: ConnectionPool,
+    tasks: list[str | Callable[[pymysql.Connection], Any]],
+    workers: int | None = None,
+) -> list:
+    """
+    Runs independent `tasks` on connections from `pool` in a thread pool.
+    A task is either a statement, whose rows are returned, or a function
+    that is called with a connection, whose return value is returned.
+    Results are in the same order as `tasks`.
+    """
+
+    def run(task):
+        with pool.connection() as conn:
+            if callable(task):
+                return task(conn)
+            cur = conn.cursor()
+            cur.execute(task)
+            rows = cur.fetchall()
+            cur.close()
+            conn.commit()
+            return rows
+
+    with ThreadPoolExecutor(max_workers=workers or pool.size) as executor:
+        return list(executor.map(run, tasks))
+
+
+_INT_TYPES = [
+    ("tinyint", 2**7),
+    ("smallint", 2**15),
+    ("mediumint", 2**23),
+    ("int", 2**31),
+    ("bigint", 2**63),
+]
+
+
+# Numbers whose text survives being stored as a number: no leading zeros
+# ("007"), no "+" sign, and no nan, inf or digit separators like "1_000"
+_INT = re.compile(r"-?(?:0|[1-9][0-9]*)")
+_FLOAT = re.compile(r"-?(?:0|[1-9][0-9]*|(?=\.))(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?")
+
+
+def _is_float(value: str) -> bool:
+    return _FLOAT.fullmatch(value) is not None and math.isfinite(float(value))
+
+
+def _infer_type(values: list[str], complete: bool, enum_max: int) -> str:
+    present = [v for v in values if v != ""]
+    not_null = " NOT NULL" if len(present) == len(values) else ""
+    if not present:
+        return "tinytext"
+
+    ints = None
+    if all(_INT.fullmatch(v) for v in present):
+        ints = [int(v) for v in present]
+    if ints is not None:
+        low, high = min(ints), max(ints)
+        unsigned = low >= 0
+        for name, limit in _INT_TYPES:
+            if (unsigned and high < 2 * limit) or (-limit <= low and high < limit):
+                return f"{name}{' unsigned' if unsigned else ''}{not_null}"
+
+    if all(_is_float(v) for v in present):
+        return f"double{not_null}"
+
+    distinct = set(present)
+    lengths = {len(v) for v in distinct}
+    longest = max(lengths)
+    # Values outside the sample would not fit in an ENUM.
+    if complete and len(distinct) <= enum_max and len(distinct) * 2 <= len(present):
+        members = ", ".join("'" + v.replace("'", "''") + "'" for v in sorted(distinct))
+        return f"enum({members}){not_null}"
+    if len(lengths) == 1 and longest <= 255:
+        return f"char({longest}){not_null}"
+    if longest <= 1024:
+        return f"varchar({longest}){not_null}"
+    return f"text{not_null}"
+
+
+def infer_column_types(
+    paths: list[str],
+    positions: list[int],
+    ignore_lines: int = 0,
+    sample_rows: int | None = None,
+    enum_max: int = 16,
+) -> list[str]:
+    """
+    Proposes the narrowest type for the csv fields at `positions`:
+    (tiny/small/medium/big)int (unsigned), double, enum for at most
+    `enum_max` distinct values, char(n) for fixed width values such as ONS
+    codes, varchar(n), or text. NOT NULL is added if no value is empty.
+    Reads at most `sample_rows` rows in total (all by default). Integer and
+    string widths are only guaranteed for the rows that were read, and enums
+    are only proposed if every row was read.
+    """
+    values = [[] for _ in positions]
+    complete = True
+    read = 0
+    for path in paths:
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            for _ in range(ignore_lines):
+                next(reader, None)
+            for row in reader:
+                if sample_rows is not None and read >= sample_rows:
+                    complete = False
+                    break
+                for column, position in zip(values, positions):
+                    column.append(row[position] if position < len(row) else "")
+                read += 1
+        if not complete:
+            break
+
+    return [_infer_type(column, complete, enum_max) for column in values]
+
+
+LOAD_REGISTRY_TABLE = "csv_load_registry"
+
+
+def create_load_registry(conn):
+    """
+    The registry records every csv file loaded by `UploadCsvConfig.upload`,
+    so files that are already in a table are not loaded again.
+    """
+    get_backend(conn).execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS `{LOAD_REGISTRY_TABLE}` (
+        `table_name` varchar(64) NOT NULL,
+        `path` varchar(512) NOT NULL,
+        `size` bigint NOT NULL,
+        `mtime` double NOT NULL,
+        `hash` char(64) DEFAULT NULL,
+        `rows` bigint NOT NULL,
+        `loaded_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        `spec` char(64) DEFAULT NULL,
+        PRIMARY KEY (`table_name`, `path`)
+        ){get_backend(conn).table_options};
+        """
+    )
+    # Registries created before the table definition was recorded
+    if not check_column_exists(conn, LOAD_REGISTRY_TABLE, "spec"):
+        execute_statement(
+            conn,
+            f"ALTER TABLE `{LOAD_REGISTRY_TABLE}` ADD COLUMN `spec` char(64) DEFAULT NULL",
+        )
+
+
 @dataclass
 class UploadCsvConfig:
+    """
+    Creates the table `name` and loads the csv file(s) in `path` into it.
+
+    Every loaded file is recorded in the load registry (`LOAD_REGISTRY_TABLE`)
+    by its size and mtime, and also its sha256 if `hash_files`, together with
+    a hash of the table definition (`columns`, `primary_key`, `order` and
+    `ignore_lines`). Files whose record still matches are skipped, so running
+    `upload` again is cheap.
+    recreate: if a loaded file changed or is no longer in `path`, or the table
+        definition changed, the table is dropped and every file is reloaded.
+        Otherwise only new files are loaded. A table that exists without any
+        registry records (loaded before the registry existed) is also
+        dropped and reloaded.
+        If False, new and changed files are appended to the table.
+    columns: (name, type) pairs. A type of None is inferred from the csv with
+        `infer_column_types`, reading at most `sample_rows` rows. If new files
+        need a wider type than the loaded ones, the table is rebuilt with
+        `recreate`, otherwise the columns are changed to the wider type.
+    """
+
     name: str
     path: str | list[str]
-    columns: list[tuple[str, str]]
+    columns: list[tuple[str, str | None]]
     # primary_key: str | None = None
     primary_key: str | None = None
     order: tuple[list[int], int] | None = None
     recreate: bool = True
     ignore_lines: int = 0
+    hash_files: bool = False
+    sample_rows: int | None = None
 
-    def _create_table(self, conn: pymysql.Connection):
-        lines = []
-        if self.recreate:
-            cur = conn.cursor()
-            # lines.append(f"DROP TABLE IF EXISTS `{self.name}`;")
-            cur.execute(f"DROP TABLE IF EXISTS `{self.name}`;")
+    def column_types(self, paths: list[str] | None = None) -> list[tuple[str, str]]:
+        """
+        `columns` with every None type replaced by the type inferred from
+        `paths` (all files by default)
+        """
+        missing = [i for i, (_, rem) in enumerate(self.columns) if rem is None]
+        if not missing:
+            return list(self.columns)
+
+        positions = self.order[0] if self.order is not None else range(len(self.columns))
+        positions = list(positions)
+        inferred = infer_column_types(
+            self._paths() if paths is None else paths,
+            [positions[i] for i in missing],
+            self.ignore_lines,
+            self.sample_rows,
+        )
 
-        lines.append(f"CREATE TABLE IF NOT EXISTS `{self.name}` (")
+        columns = list(self.columns)
+        for i, rem in zip(missing, inferred):
+            columns[i] = (columns[i][0], rem)
+        return columns
+
+    def _paths(self) -> list[str]:
+        return self.path if isinstance(self.path, list) else [self.path]
+
+    def _fingerprint(self, path: str) -> tuple[int, float, str | None]:
+        stat = os.stat(path)
+        file_hash = _file_hash(path, "sha256") if self.hash_files else None
+        return stat.st_size, stat.st_mtime, file_hash
+
+    def _spec(self) -> str:
+        """Hash of the definition of the table"""
+        spec = [self.columns, self.primary_key, self.order, self.ignore_lines]
+        return hashlib.sha256(json.dumps(spec).encode()).hexdigest()
+
+    def _loaded_specs(self, conn) -> set[str]:
+        """Table definitions the loaded files were recorded with"""
+        backend = get_backend(conn)
+        rows = backend.query(
+            f"""
+            SELECT DISTINCT `spec` FROM `{LOAD_REGISTRY_TABLE}`
+            WHERE `table_name` = {backend.param} AND `spec` IS NOT NULL
+            """,
+            (self.name,),
+        )
+        return {spec for spec, in rows}
+
+    def _loaded(self, conn) -> dict[str, tuple]:
+        backend = get_backend(conn)
+        rows = backend.query(
+            f"""
+            SELECT `path`, `size`, `mtime`, `hash` FROM `{LOAD_REGISTRY_TABLE}`
+            WHERE `table_name` = {backend.param}
+            """,
+            (self.name,),
+        )
+        return {path: (size, mtime, file_hash) for path, size, mtime, file_hash in rows}
 
-        columns = [f"`{key}` {rem}" for key, rem in self.columns]
-        if self.primary_key is not None:
-            columns.append(
-                f"`{self.primary_key}` bigint(20) unsigned NOT NULL AUTO_INCREMENT PRIMARY KEY"
+    def _widened_types(
+        self, paths: list[str], pending: list[str], loaded: dict[str, tuple]
+    ) -> list[tuple[str, str]]:
+        """
+        The inferred columns whose type changes once `pending` is added to
+        the files already loaded, with their new type
+        """
+        if all(rem is not None for _, rem in self.columns):
+            return []
+        before = [
+            path
+            for path in paths
+            if path not in pending and os.path.abspath(path) in loaded
+        ]
+        if not before:
+            return []
+        old = self.column_types(before)
+        new = self.column_types(before + pending)
+        return [column for column, was in zip(new, old) if column != was]
+
+    def _clear_registry(self, conn):
+        backend = get_backend(conn)
+        backend.execute(
+            f"DELETE FROM `{LOAD_REGISTRY_TABLE}` WHERE `table_name` = {backend.param}",
+            (self.name,),
+        )
+
+    def _register(self, conn, path: str, fingerprint, rows: int):
+        backend = get_backend(conn)
+        params = ", ".join([backend.param] * 7)
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            REPLACE INTO `{LOAD_REGISTRY_TABLE}`
+            (`table_name`, `path`, `size`, `mtime`, `hash`, `rows`, `spec`)
+            VALUES ({params})
+            """,
+            (self.name, os.path.abspath(path), *fingerprint, rows, self._spec()),
+        )
+        cur.close()
+
+    def _create_table(self, conn, drop: bool | None = None):
+        get_backend(conn).create_table(
+            self.name,
+            self.column_types(),
+            self.primary_key,
+            drop=self.recreate if drop is None else drop,
+        )
+
+    def _load_file(self, conn, path: str, fingerprint) -> int:
+        """Loads and registers a single file in its own transaction"""
+        try:
+            rows = get_backend(conn).load_csv(
+                self.name,
+                path,
+                [key for key, _ in self.columns],
+                self.order,
+                self.ignore_lines,
+            )
+            self._register(conn, path, fingerprint, rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return rows
+
+    def _load_data_infile(
+        self,
+        conn,
+        paths: list[str] | None = None,
+        fingerprints: dict[str, tuple] | None = None,
+        pool: ConnectionPool | None = None,
+        concurrency: int | None = None,
+    ):
+        """
+        Loads `paths` (all files by default) and records them in the load
+        registry. Each file is committed on its own.
+        If a `pool` is given, the files are loaded in parallel with one pooled
+        connection per worker. Files that fail don't stop the others and are
+        reported together in an `UploadError` at the end.
+        On MariaDB, loads into a table with a `primary_key` (an AUTO_INCREMENT
+        column) only run in parallel if the server has
+        `innodb_autoinc_lock_mode = 2`, otherwise they are loaded one by one.
+        """
+        if paths is None:
+            paths = self._paths()
+        if fingerprints is None:
+            fingerprints = {path: self._fingerprint(path) for path in paths}
+
+        backend = get_backend(conn)
+        if pool is not None and not backend.concurrent_loads(
+            self.primary_key is not None
+        ):
+            print(
+                f"Loading `{self.name}` sequentially: its AUTO_INCREMENT column "
+                "serialises parallel loads unless innodb_autoinc_lock_mode = 2."
+            )
+            pool = None
+        backend.begin_bulk_load(self.name)
+
+        failed = {}
+        try:
+            if pool is None:
+                for path in paths:
+                    self._load_file(conn, path, fingerprints[path])
+            else:
+
+                def load(path):
+                    def task(pool_conn):
+                        try:
+                            self._load_file(pool_conn, path, fingerprints[path])
+                        except Exception as e:
+                            return e
+
+                    return task
+
+                errors = run_parallel(pool, [load(path) for path in paths], concurrency)
+                failed = {
+                    path: error for path, error in zip(paths, errors) if error is not None
+                }
+        finally:
+            backend.end_bulk_load(self.name)
+
+        if failed:
+            raise UploadError(self.name, failed)
+
+    def upload(
+        self,
+        conn,
+        pool: ConnectionPool | None = None,
+        concurrency: int | None = None,
+    ) -> list[str]:
+        """
+        Returns the paths that were loaded.
+        pool, concurrency: load the files in parallel, see `_load_data_infile`.
+            After an `UploadError`, calling `upload` again only loads the files
+            that failed.
+        """
+        create_load_registry(conn)
+        exists = check_table_exists(conn, self.name)
+        if not exists:
+            self._clear_registry(conn)
+
+        paths = self._paths()
+        loaded = self._loaded(conn)
+        fingerprints = {path: self._fingerprint(path) for path in paths}
+        pending = [
+            path
+            for path in paths
+            if loaded.get(os.path.abspath(path)) != fingerprints[path]
+        ]
+
+        rebuild = False
+        if self.recreate:
+            wanted = {os.path.abspath(path): fingerprints[path] for path in paths}
+            # Rows of changed or removed files can't be taken out of the table,
+            # and neither can those of a table loaded before the registry.
+            # Files recorded without a definition are assumed to match it.
+            rebuild = (
+                (exists and not loaded)
+                or any(wanted.get(path) != fp for path, fp in loaded.items())
+                or bool(self._loaded_specs(conn) - {self._spec()})
             )
-            # columns.append("PRIMARY KEY (`id`)")
 
-        lines.append(",\n".join(columns))
-        lines.append(") DEFAULT CHARSET=utf8 COLLATE=utf8_bin;")
+        # Types were inferred from the files loaded so far, so the values of
+        # new files may not fit them.
+        widen = []
+        if exists and pending and not rebuild:
+            widen = self._widened_types(paths, pending, loaded)
+            if widen and self.recreate:
+                rebuild = True
 
-        statement = "\n".join(lines)
-        print(statement)
+        if rebuild:
+            pending = paths
 
-        cur = conn.cursor()
-        cur.execute(statement)
-        conn.commit()
-
-    def _load_data_infile(self, conn: pymysql.Connection):
-        paths = self.path if isinstance(self.path, list) else [self.path]
-        for path in paths:
-            statement = rf"""
-            LOAD DATA LOCAL INFILE "{path}"
-            INTO TABLE `{self.name}`
-            FIELDS TERMINATED BY ','
-            OPTIONALLY ENCLOSED by '"'
-            LINES STARTING BY ''
-            TERMINATED BY '\n'
-            IGNORE {self.ignore_lines or 0} lines
-            """
-            if self.order is not None:
-                order, size = self.order
-                upload = ["@dummy"] * size
-                for (key, _), idx in zip(self.columns, order):
-                    upload[idx] = f"`{key}`"
-
-                statement = f"""
-                {statement}
-                ({", ".join(upload)})
-                """
-
-            print(statement)
+        if not pending:
+            print(f"All files are already loaded into `{self.name}`.")
+            return []
 
-            cur = conn.cursor()
-            cur.execute(statement)
-        conn.commit()
+        if rebuild:
+            self._clear_registry(conn)
+        elif widen:
+            get_backend(conn).modify_columns(self.name, widen)
+        self._create_table(conn, drop=rebuild)
+        self._load_data_infile(conn, pending, fingerprints, pool, concurrency)
+        return pending
 
-    def upload(self, conn: pymysql.Connection):
-        # TODO:
-        # recreate flag doesn't currently work corrently.
-        # It will still reupload the csv even if the table is there.
-        # This is not necessarily what we want?
-        # We could add another flag - reupload?
-        self._create_table(conn)
-        self._load_data_infile(conn)
 
+class UploadError(Exception):
+    """Raised by `UploadCsvConfig.upload` with the files that failed to load"""
 
-def add_primary_key(conn: pymysql.Connection, table: str, field: str):
-    statement = f"""
-    ALTER TABLE `{table}`
-    ADD PRIMARY KEY (`{field}`)
-    """
-    print(statement)
-    cur = conn.cursor()
-    cur.execute(statement)
-    conn.commit()
+    def __init__(self, table: str, failed: dict[str, Exception]):
+        self.table = table
+        self.failed = failed
+        super().__init__(f"Failed to load {len(failed)} file(s) into `{table}`: {failed}")
+
+
+def execute_statement(conn, statement: str):
+    get_backend(conn).execute(statement)
+
+
+def add_primary_key(conn, table: str, field: str):
+    get_backend(conn).add_primary_key(table, field)
 
 
 def add_index(
-    conn: pymysql.Connection,
+    conn,
     table: str,
     index_column: str | list[str],
     index_name: str | None = None,
 ):
     if isinstance(index_column, str):
         index_column = [index_column]
-    columns = ", ".join(f"`{c}`" for c in index_column)
-
-    statement = f"""
-    ALTER TABLE `{table}`
-    ADD INDEX {f"`{index_name}`" if index_name else ""}({columns})
-    """
-    print(statement)
-    cur = conn.cursor()
-    cur.execute(statement)
-    conn.commit()
+    get_backend(conn).add_index(table, index_column, index_name)
 
 
 def check_table_exists(conn, table):
-    cur = conn.cursor()
-    cur.execute(
-        f"""
-        SELECT COUNT(*)
-        FROM information_schema.tables
-        WHERE table_name = "{table}" 
-        """
-    )
-    if cur.fetchone()[0] == 1:
-        cur.close()
-        return True
+    return get_backend(conn).table_exists(table)
+
+
+def check_column_exists(conn, table, column):
+    return get_backend(conn).column_exists(table, column)
+
 
-    cur.close()
-    return False
+def check_index_exists(conn, table, index):
+    return get_backend(conn).index_exists(table, index)
+
+
+def add_spatial_index(
+    conn: pymysql.Connection,
+    table: str,
+    column: str = "location",
+    lat: str = "lat",
+    lon: str = "lon",
+):
+    """
+    Adds a POINT(`lon`, `lat`) column `column` to `table` with a SPATIAL INDEX
+    of the same name. Anything that already exists is left as it is.
+    Only supported on MariaDB.
+    """
+    if is_embedded(conn):
+        raise NotImplementedError("Spatial indexes are only supported on MariaDB")
+
+    if not check_column_exists(conn, table, column):
+        execute_statement(conn, f"ALTER TABLE `{table}` ADD COLUMN `{column}` POINT")
+        execute_statement(
+            conn, f"UPDATE `{table}` SET `{column}` = Point(`{lon}`, `{lat}`)"
+        )
+        # A spatial index needs the column to be NOT NULL.
+        execute_statement(
+            conn, f"ALTER TABLE `{table}` MODIFY `{column}` POINT NOT NULL"
+        )
+
+    if not check_index_exists(conn, table, column):
+        execute_statement(
+            conn, f"ALTER TABLE `{table}` ADD SPATIAL INDEX `{column}` (`{column}`)"
+        )
 
 
 def create_separate_table(
@@ -215,18 +827,102 @@ def create_separate_table(
     WHERE {where}
     """
 
-    print(statement)
+    execute_statement(conn, statement)
 
-    cur = conn.cursor()
-    cur.execute(statement)
-    conn.commit()
 
+QUERY_CACHE_MAX_BYTES = 2 * 2**30
 
-def load_table_df(conn, table) -> pd.DataFrame:
-    statement = f"SELECT * FROM {table}"
+
+def get_query_cache_path() -> str:
+    return get_download_path("query_cache/")
+
+
+def get_table_versions(conn, tables: list[str]) -> list:
+    """
+    The (table, create time, update time, approximate row count) of every
+    table, used to invalidate cached query results when a table changes.
+    """
+    return get_backend(conn).table_versions(tables)
+
+
+def _evict_query_cache(cache_dir: str, max_bytes: int):
+    """Removes the least recently used results until the cache fits in `max_bytes`"""
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".parquet"):
+            path = os.path.join(cache_dir, filename)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        os.remove(path.removesuffix(".parquet") + ".json")
+        total -= size
+
+
+def read_sql_cached(
+    statement: str,
+    conn,
+    tables: list[str],
+    max_bytes: int = QUERY_CACHE_MAX_BYTES,
+) -> pd.DataFrame:
+    """
+    `pd.read_sql` with the result stored as Parquet in `get_query_cache_path()`.
+    The cache key is the statement and the `get_table_versions` of `tables`,
+    which must include every table the statement reads.
+    The least recently used results are evicted beyond `max_bytes`.
+    """
+    cache_dir = get_query_cache_path()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    key = json.dumps(
+        [
+            str(getattr(conn, "host", "")),
+            str(getattr(conn, "db", "")),
+            statement,
+            get_table_versions(conn, tables),
+        ]
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    data_path = os.path.join(cache_dir, f"{digest}.parquet")
+    meta_path = os.path.join(cache_dir, f"{digest}.json")
+
+    if os.path.exists(data_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            columns = json.load(f)["columns"]
+        df = pd.read_parquet(data_path)
+        df.columns = columns
+        os.utime(data_path)
+        return df
+
+    df = pd.read_sql(statement, conn)
+
+    # Parquet needs unique string column names, but joins can repeat names.
+    df.set_axis([str(i) for i in range(len(df.columns))], axis=1).to_parquet(
+        data_path
+    )
+    with open(meta_path, "w") as f:
+        json.dump({"statement": statement, "columns": list(df.columns)}, f)
+
+    _evict_query_cache(cache_dir, max_bytes)
+    return df
+
+
+def read_sql(statement: str, conn, tables: list[str], cache: bool = False):
+    """`pd.read_sql`, or `read_sql_cached` if `cache`"""
+    if cache:
+        return read_sql_cached(statement, conn, tables)
     return pd.read_sql(statement, conn)
 
 
+def load_table_df(conn, table, cache: bool = False) -> pd.DataFrame:
+    statement = f"SELECT * FROM {table}"
+    return read_sql(statement, conn, [table], cache)
+
+
 def normalise_df(
     df: pd.DataFrame,
     columns: list[str],
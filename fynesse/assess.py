@@ -1,8 +1,16 @@
+import json
+import os
+import sqlite3
+
+import numpy as np
 import pandas as pd
 import osmnx as ox
+import scipy.sparse as sp
 import matplotlib.pyplot as plt
 import math
-from sklearn.cluster import KMeans
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
 from scipy.spatial.distance import pdist, squareform
 
 from .config import *
@@ -40,25 +48,51 @@ def labelled(data):
     raise NotImplementedError
 
 
-def count_pois_near_coordinates(
-    latitude: float, longitude: float, tags: dict, distance_km: float = 1.0
-) -> dict:
-    """
-    Count Points of Interest (POIs) near a given pair of coordinates within a specified distance.
-    Args:
-        latitude (float): Latitude of the location.
-        longitude (float): Longitude of the location.
-        tags (dict): A dictionary of OSM tags to filter the POIs (e.g., {'amenity': True, 'tourism': True}).
-        distance_km (float): The distance around the location in kilometers. Default is 1 km.
-    Returns:
-        dict: A dictionary where keys are the OSM tags and values are the counts of POIs for each tag.
-    """
+POI_BACKENDS = ("osmnx", "sql", "memory")
+
+
+def get_poi_cache_path() -> str:
+    return access.utils.get_download_path("poi_cache.sqlite")
+
+
+def _poi_cache_key(backend, latitude, longitude, tags, distance_km, version):
+    tags = {
+        tag: values if isinstance(values, (bool, str)) else sorted(values)
+        for tag, values in sorted(tags.items())
+    }
+    return json.dumps(
+        [backend, round(latitude, 7), round(longitude, 7), tags, distance_km, version]
+    )
+
+
+def _open_poi_cache() -> sqlite3.Connection:
+    path = get_poi_cache_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cache = sqlite3.connect(path)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS poi_counts (key TEXT PRIMARY KEY, counts TEXT)"
+    )
+    return cache
+
+
+def _poi_cache_version(conn, backend: str, tags: dict):
+    """Local counts are only valid while the subtables they were read from are unchanged"""
+    if backend == "osmnx":
+        return None
+    tables = access.osm.download.create_subtables_bulk(
+        conn, [(key, None) for key in tags]
+    )
+    return access.utils.get_table_versions(conn, tables)
+
+
+def _osmnx_poi_counts(latitude, longitude, tags: dict, distance_km: float) -> dict:
     dist = distance_km * 1000
     pois = ox.features_from_point((latitude, longitude), tags, dist)
 
     pois_df = pd.DataFrame(pois)
-    pois_df["latitude"] = pois_df.apply(lambda row: row.geometry.centroid.y, axis=1)
-    pois_df["longitude"] = pois_df.apply(lambda row: row.geometry.centroid.x, axis=1)
+    centroids = pois.geometry.centroid
+    pois_df["latitude"] = centroids.y
+    pois_df["longitude"] = centroids.x
 
     poi_counts = {}
     for tag, values in tags.items():
@@ -67,36 +101,227 @@ def count_pois_near_coordinates(
             if values is True:
                 indices = column.notnull()
             else:
-                indices = column.isin(values)
+                indices = column.isin([values] if isinstance(values, str) else values)
             count = indices.sum()
         else:
             count = 0
-        poi_counts[tag] = count
+        poi_counts[tag] = int(count)
 
     return poi_counts
 
 
+def count_pois_near_coordinates_batched(
+    coordinates: list[tuple[float, float]],
+    tags: dict,
+    distance_km: float = 1.0,
+    backend: str = "osmnx",
+    conn=None,
+    cache: bool = True,
+) -> pd.DataFrame:
+    """
+    `count_pois_near_coordinates` for every (latitude, longitude) in
+    `coordinates`, returning a DataFrame with one row per location and one
+    column per tag. Locations that are not cached are counted together:
+    with the local backends in a single query (or index lookup) for all of
+    them, with osmnx one request each.
+    """
+    if backend not in POI_BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if backend != "osmnx" and conn is None:
+        raise ValueError(f"The {backend} backend needs a database connection")
+
+    coordinates = [(float(lat), float(lon)) for lat, lon in coordinates]
+    results: list[dict | None] = [None] * len(coordinates)
+
+    cache_db = _open_poi_cache() if cache else None
+    version = _poi_cache_version(conn, backend, tags) if cache else None
+    keys = [
+        _poi_cache_key(backend, lat, lon, tags, distance_km, version)
+        for lat, lon in coordinates
+    ]
+    if cache_db is not None:
+        for i, key in enumerate(keys):
+            row = cache_db.execute(
+                "SELECT counts FROM poi_counts WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                results[i] = json.loads(row[0])
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing and backend == "osmnx":
+        for i in missing:
+            results[i] = _osmnx_poi_counts(*coordinates[i], tags, distance_km)
+    elif missing:
+        lats, lons = np.array([coordinates[i] for i in missing]).T
+        # osmnx looks `distance_km` in every direction from the point
+        coords = access.osm.download.get_box_coords_array(lats, lons, 2 * distance_km)
+        counts = access.osm.download.get_osm_tag_counts(conn, tags, coords, backend)
+        for i, row in zip(missing, counts.to_dict("records")):
+            results[i] = {tag: int(count) for tag, count in row.items()}
+
+    if cache_db is not None:
+        with cache_db:
+            cache_db.executemany(
+                "REPLACE INTO poi_counts (key, counts) VALUES (?, ?)",
+                [(keys[i], json.dumps(results[i])) for i in missing],
+            )
+        cache_db.close()
+
+    return pd.DataFrame(results, columns=list(tags))
+
+
+def count_pois_near_coordinates(
+    latitude: float,
+    longitude: float,
+    tags: dict,
+    distance_km: float = 1.0,
+    backend: str = "osmnx",
+    conn=None,
+    cache: bool = True,
+) -> dict:
+    """
+    Count Points of Interest (POIs) near a given pair of coordinates within a specified distance.
+    Args:
+        latitude (float): Latitude of the location.
+        longitude (float): Longitude of the location.
+        tags (dict): A dictionary of OSM tags to filter the POIs (e.g., {'amenity': True, 'tourism': True}).
+        distance_km (float): The distance around the location in kilometers. Default is 1 km.
+        backend (str): "osmnx" queries the OSM servers. "sql" and "memory" count
+            the tagged nodes of the ingested `osm` table through `conn`, with a
+            query or an in memory index. They only see nodes, not ways.
+        conn: Database connection for the "sql" and "memory" backends.
+        cache (bool): Store the counts in `get_poi_cache_path()` and reuse them.
+    Returns:
+        dict: A dictionary where keys are the OSM tags and values are the counts of POIs for each tag.
+    """
+    df = count_pois_near_coordinates_batched(
+        [(latitude, longitude)], tags, distance_km, backend, conn, cache
+    )
+    return df.iloc[0].to_dict()
+
+
 def get_feature_counts(
-    locations_dict: dict[str, tuple[int, int]], tags: dict[str, bool | list[str]]
+    locations_dict: dict[str, tuple[int, int]],
+    tags: dict[str, bool | list[str]],
+    backend: str = "osmnx",
+    conn=None,
+    distance_km: float = 1.0,
 ):
-    feature_counts = []
-    for location, coordinates in locations_dict.items():
-        poi_counts = count_pois_near_coordinates(*coordinates, tags, 1)
-        feature_counts.append({**poi_counts, "location": location})
-    return pd.DataFrame(feature_counts)
+    feature_counts = count_pois_near_coordinates_batched(
+        list(locations_dict.values()), tags, distance_km, backend, conn
+    )
+    feature_counts["location"] = list(locations_dict)
+    return feature_counts
 
 
 def drop_location(df):
-    return feature_counts_df.drop(columns=["location"])
+    return df.drop(columns=["location"])
+
+
+def _group_locations(locations, labels) -> dict:
+    """{label: [locations with that label]} without a loop over the rows"""
+    locations = np.asarray(locations)
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind="stable")
+    keys, starts = np.unique(labels[order], return_index=True)
+    return {
+        key: list(group)
+        for key, group in zip(keys, np.split(locations[order], starts[1:]))
+    }
+
+
+def kmeans_features(
+    feature_counts_df,
+    n_clusters: int,
+    mini_batch: bool = False,
+    batch_size: int = 4096,
+    random_state=None,
+):
+    """
+    mini_batch: fit with MiniBatchKMeans, which scales to every OA. See
+        `kmeans_chunked` for features that don't fit in memory.
+    """
+    if mini_batch:
+        kmeans = MiniBatchKMeans(
+            n_clusters=n_clusters, batch_size=batch_size, random_state=random_state
+        )
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, random_state=random_state)
+    labels = kmeans.fit(_feature_array(feature_counts_df))
+    return _group_locations(feature_counts_df["location"], labels.labels_)
+
+
+def kmeans_chunked(
+    features,
+    n_clusters: int,
+    chunk_size: int = 65536,
+    epochs: int = 3,
+    batch_size: int = 4096,
+    random_state=None,
+) -> tuple[MiniBatchKMeans, np.ndarray]:
+    """
+    Mini-batch k-means over an (N, D) array that is read `chunk_size` rows
+    at a time, e.g. the memory-mapped `values` of a `CensusMatrix`, so only
+    one chunk is ever in memory as float32.
+    Returns the fitted model and the label of every row.
+    """
+    kmeans = MiniBatchKMeans(
+        n_clusters=n_clusters, batch_size=batch_size, random_state=random_state
+    )
+    rng = np.random.default_rng(random_state)
+    starts = np.arange(0, len(features), chunk_size)
+
+    for _ in range(epochs):
+        for start in rng.permutation(starts):
+            chunk = _feature_array(features[start : start + chunk_size])
+            # The first chunk must have at least one row per cluster.
+            if not hasattr(kmeans, "cluster_centers_") and len(chunk) < n_clusters:
+                continue
+            kmeans.partial_fit(chunk)
+
+    labels = np.empty(len(features), dtype=np.int32)
+    for start in starts:
+        chunk = _feature_array(features[start : start + chunk_size])
+        labels[start : start + len(chunk)] = kmeans.predict(chunk)
+    return kmeans, labels
+
+
+def _score_n_clusters(X, sample, n_clusters, batch_size, random_state):
+    kmeans = MiniBatchKMeans(
+        n_clusters=n_clusters, batch_size=batch_size, random_state=random_state
+    ).fit(X)
+    labels = kmeans.predict(X[sample])
+    silhouette = (
+        silhouette_score(X[sample], labels)
+        if 1 < len(np.unique(labels)) < len(sample)
+        else np.nan
+    )
+    return n_clusters, kmeans.inertia_, silhouette
+
 
+def search_n_clusters(
+    features,
+    n_clusters: list[int],
+    sample_size: int = 10_000,
+    batch_size: int = 4096,
+    n_jobs: int | None = -1,
+    random_state=None,
+) -> pd.DataFrame:
+    """
+    Fits a mini-batch k-means for every number of clusters in `n_clusters`
+    in parallel and returns the inertia (for the elbow method) and the
+    silhouette score of each. The silhouette score is quadratic in the
+    number of rows, so it is computed on a sample of `sample_size` rows.
+    """
+    X = _feature_array(features)
+    rng = np.random.default_rng(random_state)
+    sample = rng.choice(len(X), min(sample_size, len(X)), replace=False)
 
-def kmeans_features(feature_counts_df, n_clusters: int):
-    kmeans = KMeans(n_clusters=n_clusters)
-    labels = kmeans.fit(drop_location(feature_counts_df))
-    groups = {}
-    for i, label in enumerate(labels.labels_):
-        groups.setdefault(label, []).append(feature_counts_df.loc[i]["location"])
-    return groups
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_score_n_clusters)(X, sample, k, batch_size, random_state)
+        for k in n_clusters
+    )
+    return pd.DataFrame(results, columns=["n_clusters", "inertia", "silhouette"])
 
 
 def normalize_feature_counts(feature_counts_df, drop=False):
@@ -113,6 +338,10 @@ def normalize_feature_counts(feature_counts_df, drop=False):
 
 
 def get_distance_matrix(feature_counts_df):
+    """
+    Dense distances between all locations. See `nearest_neighbours` and
+    `distance_threshold_matrix` for more locations than fit in memory.
+    """
     distance_vector = pdist(drop_location(feature_counts_df))
     distance_matrix = squareform(distance_vector)
     return pd.DataFrame(
@@ -122,6 +351,126 @@ def get_distance_matrix(feature_counts_df):
     )
 
 
+# Default memory budget of a single block of distances
+DISTANCE_BLOCK_BYTES = 256 * 2**20
+
+
+def _feature_array(features) -> np.ndarray:
+    """The features as a float32 array, without the "location" column"""
+    if isinstance(features, pd.DataFrame):
+        features = features.drop(columns=["location"], errors="ignore")
+    return np.ascontiguousarray(features, dtype=np.float32)
+
+
+def iter_distance_blocks(X, Y=None, memory_bytes: int = DISTANCE_BLOCK_BYTES):
+    """
+    Yields (start, stop, block) where block holds the float32 euclidean
+    distances between rows start:stop of `X` and every row of `Y` (`X` by
+    default). Blocks are sized so the block and its temporaries fit in
+    about `memory_bytes`, so the full matrix never has to be held.
+    """
+    X = _feature_array(X)
+    Y = X if Y is None else _feature_array(Y)
+
+    # Centering keeps the expansion below accurate in float32.
+    center = Y.mean(axis=0) if len(Y) else 0
+    X = X - center
+    Y = Y - center
+    y_norms = np.einsum("ij,ij->i", Y, Y)
+
+    # Per distance: the float32 block plus the int64 indices and masks that
+    # callers make of it.
+    rows = max(1, memory_bytes // (16 * max(len(Y), 1)))
+    for start in range(0, len(X), rows):
+        x = X[start : start + rows]
+        # |x - y|^2 = |x|^2 + |y|^2 - 2 x.y
+        block = x @ Y.T
+        block *= -2
+        block += np.einsum("ij,ij->i", x, x)[:, None]
+        block += y_norms[None, :]
+        np.maximum(block, 0, out=block)
+        np.sqrt(block, out=block)
+        yield start, start + len(x), block
+
+
+def nearest_neighbours(
+    X, k: int, Y=None, memory_bytes: int = DISTANCE_BLOCK_BYTES
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The `k` nearest rows of `Y` for every row of `X`, returned as (indices,
+    distances), both of shape (len(X), k) and sorted by distance.
+    If `Y` is None the neighbours are taken from `X`, excluding the row itself.
+    """
+    exclude_self = Y is None
+    n_y = len(X) if Y is None else len(Y)
+    k = min(k, n_y - exclude_self)
+
+    indices = np.zeros((len(X), k), dtype=np.int64)
+    distances = np.zeros((len(X), k), dtype=np.float32)
+    if k <= 0:
+        return indices, distances
+
+    for start, stop, block in iter_distance_blocks(X, Y, memory_bytes):
+        if exclude_self:
+            rows = np.arange(stop - start)
+            block[rows, rows + start] = np.inf
+        part = np.argpartition(block, k - 1, axis=1)[:, :k]
+        part_dist = np.take_along_axis(block, part, axis=1)
+        order = np.argsort(part_dist, axis=1, kind="stable")
+        indices[start:stop] = np.take_along_axis(part, order, axis=1)
+        distances[start:stop] = np.take_along_axis(part_dist, order, axis=1)
+    return indices, distances
+
+
+def distance_threshold_matrix(
+    X, threshold: float, Y=None, memory_bytes: int = DISTANCE_BLOCK_BYTES
+) -> sp.csr_matrix:
+    """
+    Sparse (len(X), len(Y)) float32 matrix of the distances that are at most
+    `threshold`. If `Y` is None it is `X` and the diagonal is left out, so
+    every stored entry is a pair of distinct rows. Exact duplicates are
+    stored as explicit zeros.
+    """
+    exclude_self = Y is None
+    n_y = len(X) if Y is None else len(Y)
+
+    rows, cols, data = [], [], []
+    for start, stop, block in iter_distance_blocks(X, Y, memory_bytes):
+        r, c = np.nonzero(block <= threshold)
+        if exclude_self:
+            keep = r + start != c
+            r, c = r[keep], c[keep]
+        rows.append(r + start)
+        cols.append(c)
+        data.append(block[r, c])
+
+    if not rows:
+        return sp.csr_matrix((len(X), n_y), dtype=np.float32)
+    return sp.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(X), n_y),
+        dtype=np.float32,
+    )
+
+
+def get_nearest_locations(feature_counts_df, k: int = 5) -> pd.DataFrame:
+    """
+    The `k` most similar locations to each location of `feature_counts_df`,
+    computed blockwise so it scales to every OA. One row per (location,
+    neighbour) pair with their distance and rank.
+    """
+    indices, distances = nearest_neighbours(feature_counts_df, k)
+    locations = feature_counts_df["location"].to_numpy()
+    return pd.DataFrame(
+        {
+            "location": np.repeat(locations, indices.shape[1]),
+            "neighbour": locations[indices.ravel()],
+            "distance": distances.ravel(),
+            "rank": np.tile(np.arange(1, indices.shape[1] + 1), len(locations)),
+        }
+    )
+
+
 def filter_nan_columns(df, columns):
     """For any column in `columns`, it is removed from `df` iff any of the rows contain a
     NaN value for that column"""
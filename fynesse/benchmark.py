@@ -0,0 +1,494 @@
+"""
+Benchmarks for the hot paths of `fynesse.access` on synthetic data.
+
+Everything runs offline against an embedded SQLite database in a temporary
+directory. The data is generated deterministically from `seed`, and its size
+grows linearly with `scale`. Results are written as JSON so that runs can be
+compared with `compare`:
+
+    python -m fynesse.benchmark --scale 1 --output before.json
+    python -m fynesse.benchmark --scale 1 --output after.json
+    python -m fynesse.benchmark --compare before.json after.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from typing import Callable
+
+import numpy as np
+import osmium
+import pandas as pd
+
+from fynesse.access.backend import create_embedded_connection
+from fynesse.access.census import COLUMNS_MAP, load_census_2021_for_constituency
+from fynesse.access.database import (
+    Feature,
+    get_features,
+    get_features_batched,
+    nearest_entries,
+    nearest_entry,
+)
+from fynesse.access.election import ALL_PARTIES, _create_columns
+from fynesse.access.osm.download import (
+    get_box_coords_array,
+    get_osm_counts,
+    get_osm_counts_batched,
+    osm_to_csv,
+)
+from fynesse.access.utils import UploadCsvConfig, normalise_df
+
+
+# Rough bounding box of Great Britain
+UK_BOUNDS = (50.0, -5.7, 58.6, 1.7)
+
+OSM_TAGS = [
+    ("amenity", ["school", "cafe", "pub", "restaurant", "hospital", "bench"]),
+    ("shop", ["supermarket", "convenience", "bakery", "clothes"]),
+    ("building", ["yes", "house", "residential", "university"]),
+    ("highway", ["bus_stop", "crossing", "street_lamp"]),
+    ("name", None),
+]
+
+# Number of rows of each dataset at scale 1
+BASE_SIZES = {
+    "osm_nodes": 100_000,
+    "oas": 5_000,
+    "msoas": 500,
+    "constituencies": 60,
+    "queries": 200,
+}
+
+
+def _sizes(scale: float) -> dict[str, int]:
+    return {name: max(1, int(size * scale)) for name, size in BASE_SIZES.items()}
+
+
+def generate_points(rng: np.random.Generator, n: int, clusters: int = 200):
+    """(lats, lons) clustered around `clusters` towns, like real UK data"""
+    min_lat, min_lon, max_lat, max_lon = UK_BOUNDS
+    town_lats = rng.uniform(min_lat, max_lat, clusters)
+    town_lons = rng.uniform(min_lon, max_lon, clusters)
+    town = rng.integers(0, clusters, n)
+    lats = np.clip(town_lats[town] + rng.normal(0, 0.05, n), min_lat, max_lat)
+    lons = np.clip(town_lons[town] + rng.normal(0, 0.08, n), min_lon, max_lon)
+    return lats, lons
+
+
+def generate_osm_pbf(path: str, n_nodes: int, seed: int = 0) -> str:
+    """A PBF file of `n_nodes` nodes, most with one to three tags from `OSM_TAGS`"""
+    rng = np.random.default_rng(seed)
+    lats, lons = generate_points(rng, n_nodes)
+    n_tags = rng.choice([0, 1, 2, 3], n_nodes, p=[0.2, 0.5, 0.2, 0.1])
+    timestamp = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    with osmium.SimpleWriter(path) as writer:
+        for i in range(n_nodes):
+            tags = {}
+            for k in rng.choice(len(OSM_TAGS), n_tags[i], replace=False):
+                key, values = OSM_TAGS[k]
+                tags[key] = f"node {i}" if values is None else str(rng.choice(values))
+            writer.add_node(
+                osmium.osm.mutable.Node(
+                    id=i + 1,
+                    location=(float(lons[i]), float(lats[i])),
+                    tags=tags,
+                    timestamp=timestamp,
+                    version=1,
+                )
+            )
+    return path
+
+
+def generate_census_csv(path: str, areas: list[str], code: str = "ts062", seed: int = 0):
+    """A csv laid out like the Nomis census downloads for the table `code`"""
+    rng = np.random.default_rng(seed)
+    columns = [key for key, _ in COLUMNS_MAP[code][3:]]
+    parts = rng.integers(0, 200, (len(areas), len(columns) - 1))
+    df = pd.DataFrame(
+        np.column_stack([parts.sum(axis=1), parts]), columns=columns
+    )
+    df.insert(0, "geography code", areas)
+    # OA and MSOA downloads use the code as the name of the geography too
+    df.insert(0, "geography", areas)
+    df.insert(0, "date", 2021)
+    df.to_csv(path, index=False)
+    return path
+
+
+def generate_oa_boundaries_csv(path: str, oas: list[str], seed: int = 0):
+    """A csv with the columns used by `upload_2021_oa_boundaries`"""
+    rng = np.random.default_rng(seed)
+    lats, lons = generate_points(rng, len(oas))
+    df = pd.DataFrame(
+        {
+            "FID": range(1, len(oas) + 1),
+            "OA21CD": oas,
+            "LSOA21CD": "",
+            "LSOA21NM": "",
+            "LSOA21NMW": "",
+            "BNG_E": 0,
+            "BNG_N": 0,
+            "LAT": lats.round(8),
+            "LONG": lons.round(8),
+            "Shape__Area": rng.uniform(1e4, 1e6, len(oas)).round(5),
+            "Shape__Length": rng.uniform(1e2, 1e4, len(oas)).round(5),
+        }
+    )
+    df.to_csv(path, index=False)
+    return path
+
+
+def generate_election_csv(path: str, constituencies: list[str], seed: int = 0):
+    """A csv laid out like the House of Commons election results"""
+    rng = np.random.default_rng(seed)
+    votes = rng.integers(0, 20_000, (len(constituencies), len(ALL_PARTIES)))
+    valid = votes.sum(axis=1)
+    df = pd.DataFrame(
+        {
+            "ONS ID": constituencies,
+            "ONS region ID": "",
+            "Constituency name": [f"Constituency {c}" for c in constituencies],
+            "County name": "",
+            "Region name": "",
+            "Country name": "England",
+            "Constituency type": "",
+            "Declaration time": "",
+            "Member first name": "",
+            "Member surname": "",
+            "Member gender": "",
+            "Result": "Con hold",
+            "First party": "Con",
+            "Second party": "Lab",
+            "Electorate": (valid * 1.5).astype(int),
+            "Valid votes": valid,
+            "Invalid votes": rng.integers(0, 200, len(constituencies)),
+            "Majority": rng.integers(0, 10_000, len(constituencies)),
+        }
+    )
+    for i, party in enumerate(ALL_PARTIES):
+        df[party] = votes[:, i]
+    df["Of which other winner"] = 0
+    df.to_csv(path, index=False)
+    return path
+
+
+def generate_fixtures(directory: str, scale: float = 1.0, seed: int = 0) -> dict:
+    """Writes every synthetic dataset into `directory` and returns their paths"""
+    sizes = _sizes(scale)
+    oas = [f"E{i:08}" for i in range(sizes["oas"])]
+    msoas = [f"E02{i:06}" for i in range(sizes["msoas"])]
+    constituencies = [f"E14{i:06}" for i in range(sizes["constituencies"])]
+
+    lookup = pd.DataFrame(
+        {
+            "MSOA21CD": msoas,
+            "MSOA21NM": "",
+            "MSOA21NMW": "",
+            "PCON25CD": [constituencies[i % len(constituencies)] for i in range(len(msoas))],
+        }
+    )
+    lookup_path = os.path.join(directory, "msoa_2021_to_constituency_2024.csv")
+    lookup.to_csv(lookup_path, index=False)
+
+    return {
+        "sizes": sizes,
+        "osm_pbf": generate_osm_pbf(
+            os.path.join(directory, "osm.pbf"), sizes["osm_nodes"], seed
+        ),
+        "census_oa": generate_census_csv(
+            os.path.join(directory, "census-oa.csv"), oas, seed=seed
+        ),
+        "census_msoa": generate_census_csv(
+            os.path.join(directory, "census-msoa.csv"), msoas, seed=seed + 1
+        ),
+        "oa_boundaries": generate_oa_boundaries_csv(
+            os.path.join(directory, "oa_boundaries.csv"), oas, seed
+        ),
+        "election": generate_election_csv(
+            os.path.join(directory, "election.csv"), constituencies, seed
+        ),
+        "msoa_to_constituency": lookup_path,
+        "oas": oas,
+    }
+
+
+def time_call(fn: Callable[[], object], repeat: int = 3) -> dict:
+    """Runs `fn` `repeat` times with its output silenced and times each run"""
+    seconds = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+    return {
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+    }
+
+
+def run(scale: float = 1.0, seed: int = 0, repeat: int = 3) -> dict:
+    """Generates the fixtures, runs every benchmark and returns the results"""
+    results = {}
+
+    def bench(name: str, fn: Callable[[], object], repeat: int = repeat, **info):
+        results[name] = {**time_call(fn, repeat), **info}
+        print(f"{name}: {results[name]['min']:.4f}s")
+
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures = generate_fixtures(directory, scale, seed)
+        sizes = fixtures["sizes"]
+        conn = create_embedded_connection(os.path.join(directory, "bench.sqlite"))
+
+        # Ingest
+        csv_dir = os.path.join(directory, "osm")
+
+        def ingest():
+            for name in os.listdir(csv_dir) if os.path.exists(csv_dir) else []:
+                os.remove(os.path.join(csv_dir, name))
+            if os.path.exists(csv_dir):
+                os.rmdir(csv_dir)
+            osm_to_csv(osm_filepath=fixtures["osm_pbf"], basepath=csv_dir)
+
+        bench("osm_to_csv", ingest, n=sizes["osm_nodes"])
+
+        # UploadCsvConfig loads. Recreate every run so each one loads.
+        osm_paths = sorted(os.path.join(csv_dir, f) for f in os.listdir(csv_dir))
+        osm_config = UploadCsvConfig(
+            name="osm",
+            path=osm_paths,
+            columns=[
+                ("osm_id", "bigint(20) unsigned NOT NULL"),
+                ("lat", "decimal(11,8) NOT NULL"),
+                ("lon", "decimal(10,8) NOT NULL"),
+                ("timestamp", "date NOT NULL"),
+                ("key", "varchar(255) NOT NULL"),
+                ("value", "varchar(255) NOT NULL"),
+            ],
+            primary_key="id",
+        )
+
+        def upload(config: UploadCsvConfig):
+            def fn():
+                conn.execute(f"DROP TABLE IF EXISTS `{config.name}`")
+                config.upload(conn)
+
+            return fn
+
+        bench("upload_osm", upload(osm_config), n=sizes["osm_nodes"])
+        bench(
+            "upload_census_oa",
+            upload(
+                UploadCsvConfig(
+                    name="nssec_oa_2021",
+                    path=fixtures["census_oa"],
+                    columns=COLUMNS_MAP["ts062"],
+                    primary_key="id",
+                    ignore_lines=1,
+                )
+            ),
+            n=sizes["oas"],
+        )
+        bench(
+            "upload_oa_boundaries",
+            upload(
+                UploadCsvConfig(
+                    name="oa_boundaries_2021",
+                    path=fixtures["oa_boundaries"],
+                    columns=[
+                        ("oa", None),
+                        ("lat", "decimal(11,8)"),
+                        ("lon", "decimal(10,8)"),
+                        ("area", "decimal(20,5)"),
+                        ("length", "decimal(20,5)"),
+                    ],
+                    primary_key="id",
+                    order=([1, 7, 8, 9, 10], 11),
+                    ignore_lines=1,
+                )
+            ),
+            n=sizes["oas"],
+        )
+
+        bench(
+            "upload_election",
+            upload(
+                UploadCsvConfig(
+                    name="election_2024",
+                    path=fixtures["election"],
+                    columns=_create_columns(ALL_PARTIES),
+                    order=([0, 2, 5] + list(range(11, 31)), 32),
+                    primary_key="id",
+                    ignore_lines=1,
+                )
+            ),
+            n=sizes["constituencies"],
+        )
+
+        for config in [
+            UploadCsvConfig(
+                name="ts062_msoa_2021",
+                path=fixtures["census_msoa"],
+                columns=COLUMNS_MAP["ts062"],
+                primary_key="id",
+                ignore_lines=1,
+            ),
+            UploadCsvConfig(
+                name="msoa_2021_to_constituency_2024",
+                path=fixtures["msoa_to_constituency"],
+                columns=[("MSOA21CD", None), ("PCON25CD", None)],
+                primary_key="id",
+                order=([0, 3], 4),
+                ignore_lines=1,
+            ),
+        ]:
+            time_call(upload(config), repeat=1)
+        bench(
+            "load_census_2021_for_constituency",
+            lambda: load_census_2021_for_constituency(conn, "ts062", normalise=True),
+            n=sizes["msoas"],
+        )
+
+        # OSM counts
+        rng = np.random.default_rng(seed)
+        lats, lons = generate_points(rng, sizes["queries"])
+        coords = get_box_coords_array(lats, lons, 1.0)
+        # Builds the subtable and the in-memory index outside of the timings.
+        time_call(
+            lambda: get_osm_counts_batched(
+                conn, "amenity", "school", coords[:1], backend="memory"
+            ),
+            repeat=1,
+        )
+
+        bench(
+            "get_osm_counts",
+            lambda: [get_osm_counts(conn, "amenity", "school", c) for c in coords],
+            n=len(coords),
+        )
+        bench(
+            "get_osm_counts_batched",
+            lambda: get_osm_counts_batched(conn, "amenity", "school", coords),
+            n=len(coords),
+        )
+        bench(
+            "get_osm_counts_batched_memory",
+            lambda: get_osm_counts_batched(
+                conn, "amenity", "school", coords, backend="memory"
+            ),
+            n=len(coords),
+        )
+
+        # Features
+        oas = fixtures["oas"][: sizes["queries"]]
+        pois = pd.DataFrame({"lat": lats, "lon": lons})
+        features = [
+            (Feature.Count, (1.0, "amenity", "school")),
+            (Feature.Distance, pois),
+        ]
+        bench("get_features", lambda: get_features(conn, oas, features), n=len(oas))
+        bench(
+            "get_features_batched",
+            lambda: get_features_batched(conn, oas, features),
+            n=len(oas),
+        )
+
+        # Nearest entries
+        bench(
+            "nearest_entry",
+            lambda: [nearest_entry(pois, lat, lon) for lat, lon in zip(lats, lons)],
+            n=len(lats),
+        )
+        bench(
+            "nearest_entries",
+            lambda: nearest_entries(pois, lats, lons),
+            n=len(lats),
+        )
+
+        # Normalisation
+        census = pd.read_csv(fixtures["census_oa"])
+        columns = list(census.columns[3:])
+        bench(
+            "normalise_df",
+            lambda: normalise_df(census, columns[1:], target=columns[0]),
+            n=len(census),
+        )
+
+        conn.close()
+
+    return {
+        "meta": {
+            "scale": scale,
+            "seed": seed,
+            "repeat": repeat,
+            "sizes": sizes,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": results,
+    }
+
+
+def compare(before: dict, after: dict, threshold: float = 1.1) -> list[str]:
+    """
+    Prints the ratio of the fastest times of every benchmark in both runs and
+    returns the names of those that are more than `threshold` times slower.
+    """
+    for key in ["scale", "seed"]:
+        if before["meta"][key] != after["meta"][key]:
+            print(f"Warning: the runs have different {key}s")
+
+    regressions = []
+    for name, result in after["results"].items():
+        if name not in before["results"]:
+            continue
+        ratio = result["min"] / before["results"][name]["min"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = "  <- slower"
+        print(f"{name}: {ratio:.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BEFORE", "AFTER"),
+        help="compare two result files instead of running the benchmarks",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        compare(before, after)
+        return
+
+    results = run(args.scale, args.seed, args.repeat)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
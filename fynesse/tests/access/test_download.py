@@ -0,0 +1,138 @@
+import hashlib
+import http.server
+import threading
+
+import pytest
+
+from fynesse.access import utils
+
+
+DATA = bytes(range(256)) * 4096
+ETAG = '"v1"'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves `data` with the ETag `etag`, honouring Range requests (and
+    If-Range) unless `ignore_range`
+    """
+
+    data = DATA
+    etag = ETAG
+    ignore_range = False
+    # Only send this many bytes of the first response, then drop the connection
+    truncate = None
+    ranges: list = []
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        type(self).ranges.append(header)
+        data = self.data
+
+        start = 0
+        if_range = self.headers.get("If-Range")
+        if header and not self.ignore_range and if_range in (None, self.etag):
+            start = int(header.split("=")[1].rstrip("-"))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+
+        if type(self).truncate is not None:
+            body = body[: type(self).truncate]
+            type(self).truncate = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    _Handler.data = DATA
+    _Handler.etag = ETAG
+    _Handler.ignore_range = False
+    _Handler.truncate = None
+    _Handler.ranges = []
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/data.bin"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _partial(tmp_path, data: bytes, validator: str | None = ETAG):
+    """A partial download of `data` left by an earlier call"""
+    (tmp_path / "data.bin.part").write_bytes(data)
+    if validator is not None:
+        (tmp_path / "data.bin.part.validator").write_text(validator)
+    return tmp_path / "data.bin"
+
+
+def test_resumes_interrupted_download(server, tmp_path):
+    # Only whole chunks reach the partial file.
+    _Handler.truncate = 4 * 65536
+    path = utils.download_file(server, str(tmp_path / "data.bin"), chunk_size=65536)
+    assert open(path, "rb").read() == DATA
+    assert _Handler.ranges == [None, f"bytes={4 * 65536}-"]
+    assert not (tmp_path / "data.bin.part.validator").exists()
+
+
+def test_restarts_when_range_is_ignored(server, tmp_path):
+    _Handler.ignore_range = True
+    path = _partial(tmp_path, DATA[:500])
+    utils.download_file(server, str(path))
+    assert path.read_bytes() == DATA
+    assert _Handler.ranges == ["bytes=500-"]
+
+
+def test_restarts_when_file_changed(server, tmp_path):
+    # The partial file is from an older version of the file.
+    path = _partial(tmp_path, b"old" * 1000, validator='"v0"')
+    utils.download_file(server, str(path))
+    assert path.read_bytes() == DATA
+
+
+def test_restarts_without_validator(server, tmp_path):
+    path = _partial(tmp_path, b"old" * 1000, validator=None)
+    utils.download_file(server, str(path))
+    assert path.read_bytes() == DATA
+    assert _Handler.ranges == [None]
+
+
+def test_complete_partial_file(server, tmp_path):
+    path = _partial(tmp_path, DATA)
+    utils.download_file(server, str(path))
+    assert path.read_bytes() == DATA
+    assert _Handler.ranges == [f"bytes={len(DATA)}-"]
+
+
+def test_oversized_partial_file(server, tmp_path):
+    # 416 for a partial file larger than the file is not a complete download
+    path = _partial(tmp_path, DATA + b"extra")
+    utils.download_file(server, str(path))
+    assert path.read_bytes() == DATA
+    assert _Handler.ranges == [f"bytes={len(DATA) + 5}-", None]
+
+
+def test_checksum(server, tmp_path):
+    path = tmp_path / "data.bin"
+    with pytest.raises(Exception, match="Checksum mismatch"):
+        utils.download_file(server, str(path), checksum="sha256:" + "0" * 64)
+    assert not path.exists()
+    assert not (tmp_path / "data.bin.part").exists()
+
+    checksum = "sha256:" + hashlib.sha256(DATA).hexdigest()
+    utils.download_file(server, str(path), checksum=checksum)
+    assert path.read_bytes() == DATA
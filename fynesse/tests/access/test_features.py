@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import benchmark
+from fynesse.access.backend import create_embedded_connection
+from fynesse.access.census import COLUMNS_MAP
+from fynesse.access.database import Feature, get_features, get_features_batched
+from fynesse.access.osm.download import osm_to_csv
+from fynesse.access.utils import UploadCsvConfig
+
+
+@pytest.fixture(scope="module")
+def loaded(tmp_path_factory):
+    """The benchmark fixtures loaded into an embedded database"""
+    directory = str(tmp_path_factory.mktemp("fixtures"))
+    fixtures = benchmark.generate_fixtures(directory, scale=0.05)
+    conn = create_embedded_connection(os.path.join(directory, "db.sqlite"))
+
+    csv_dir = osm_to_csv(
+        osm_filepath=fixtures["osm_pbf"], basepath=os.path.join(directory, "osm")
+    )
+    configs = [
+        UploadCsvConfig(
+            name="osm",
+            path=sorted(os.path.join(csv_dir, f) for f in os.listdir(csv_dir)),
+            columns=[
+                ("osm_id", "bigint(20) unsigned NOT NULL"),
+                ("lat", "decimal(11,8) NOT NULL"),
+                ("lon", "decimal(10,8) NOT NULL"),
+                ("timestamp", "date NOT NULL"),
+                ("key", "varchar(255) NOT NULL"),
+                ("value", "varchar(255) NOT NULL"),
+            ],
+            primary_key="id",
+        ),
+        UploadCsvConfig(
+            name="nssec_oa_2021",
+            path=fixtures["census_oa"],
+            columns=COLUMNS_MAP["ts062"],
+            primary_key="id",
+            ignore_lines=1,
+        ),
+        UploadCsvConfig(
+            name="oa_boundaries_2021",
+            path=fixtures["oa_boundaries"],
+            columns=[
+                ("oa", "varchar(10)"),
+                ("lat", "decimal(11,8)"),
+                ("lon", "decimal(10,8)"),
+                ("area", "decimal(20,5)"),
+                ("length", "decimal(20,5)"),
+            ],
+            primary_key="id",
+            order=([1, 7, 8, 9, 10], 11),
+            ignore_lines=1,
+        ),
+    ]
+    for config in configs:
+        config.upload(conn)
+    return conn, fixtures
+
+
+def test_get_features_batched_matches_get_features(loaded):
+    conn, fixtures = loaded
+    oas = fixtures["oas"][:40]
+    rng = np.random.default_rng(0)
+    lats, lons = benchmark.generate_points(rng, 50)
+    features = [
+        (Feature.Count, (1.0, "amenity", "school")),
+        (Feature.Count, (2.0, "amenity", None)),
+        (Feature.Count, ([0.5, 1.0, 3.0], "amenity", "school")),
+        (Feature.Count, ([1.0, 2.0], "amenity", "school", True)),
+        (Feature.Distance, pd.DataFrame({"lat": lats, "lon": lons})),
+    ]
+
+    expected = get_features(conn, oas, features)
+    assert expected.shape == (len(oas), 8)
+    # Some of the counts must be non-zero for the comparison to mean anything
+    assert expected[:, :7].sum() > 0
+    for backend in ["sql", "memory"]:
+        np.testing.assert_allclose(
+            get_features_batched(conn, oas, features, backend=backend), expected
+        )
@@ -0,0 +1,80 @@
+import numpy as np
+
+from fynesse.access.backend import create_embedded_connection
+from fynesse.access.osm import download
+from fynesse.access.osm.index import BoxCountIndex
+
+
+def _osm_connection(path, points):
+    conn = create_embedded_connection(str(path))
+    conn.execute(
+        """
+        CREATE TABLE osm (osm_id int, lat real, lon real, timestamp text,
+        key text, value text, id integer PRIMARY KEY)
+        """
+    )
+    _add_points(conn, points)
+    return conn
+
+
+def _add_points(conn, points):
+    conn.executemany(
+        "INSERT INTO osm (osm_id, lat, lon, timestamp, key, value) VALUES (?, ?, ?, ?, ?, ?)",
+        [(i, lat, lon, "2024-01-01", "amenity", "cafe") for i, (lat, lon) in enumerate(points)],
+    )
+    conn.commit()
+
+
+def test_index_is_per_connection_and_version(tmp_path):
+    box = (51.0, -1.0, 52.0, 1.0)
+    first = _osm_connection(tmp_path / "a.sqlite", [(51.5, 0.0)])
+    second = _osm_connection(tmp_path / "b.sqlite", [(51.5, 0.0), (51.6, 0.1)])
+
+    count = lambda conn: download.get_osm_counts(conn, "amenity", "cafe", box, "memory")
+    assert count(first) == 1
+    assert count(second) == 2
+
+    # Rebuild the subtable of the first database with more points
+    _add_points(first, [(51.7, 0.2), (51.8, 0.3)])
+    first.execute("DROP TABLE osm_amenity_cafe")
+    first.execute("DROP TABLE osm_amenity_")
+    first.commit()
+    assert count(first) == 3
+
+
+def _brute_force(lats, lons, coords):
+    return np.array(
+        [
+            ((lats >= a) & (lats <= c) & (lons >= b) & (lons <= d)).sum()
+            for a, b, c, d in coords
+        ]
+    )
+
+
+def test_box_counts_match_brute_force():
+    rng = np.random.default_rng(0)
+    # Rounded so many points lie exactly on box bounds
+    lats = np.round(rng.uniform(50, 52, 20000), 3)
+    lons = np.round(rng.uniform(-1, 1, 20000), 3)
+
+    centres = np.round(rng.uniform([49.9, -1.1], [52.1, 1.1], (500, 2)), 3)
+    half = rng.choice([0, 0.001, 0.01, 0.1, 0.5], (500, 1))
+    coords = np.hstack([centres - half, centres + half])
+    special = [
+        [51.0, 0.5, 51.0, 0.5],  # a single point
+        [51.0, 1.0, 50.0, 0.0],  # inverted
+        [52.5, 0.0, 52.6, 1.0],  # north of the data
+        [48.0, -0.5, 49.0, 0.5],  # south of the data
+        [50.5, 2.0, 51.5, 3.0],  # east of the data
+        [40.0, -5.0, 60.0, 5.0],  # around all the data
+        [lats.min(), lons.min(), lats.max(), lons.max()],  # bounds of the data
+    ]
+    coords = np.vstack([coords, special])
+    expected = _brute_force(lats, lons, coords)
+
+    for strip_height in [0.003, 0.01, 0.05]:
+        index = BoxCountIndex(lats, lons, strip_height)
+        assert (index.count(coords, chunk_size=37) == expected).all()
+
+        box, _, _ = index.candidates(coords)
+        assert (np.bincount(box, minlength=len(coords)) == expected).all()
@@ -0,0 +1,64 @@
+from fynesse.access import utils
+from fynesse.access.backend import create_embedded_connection, get_backend
+from fynesse.access.utils import check_index_exists
+
+
+def test_recreate_reloads_table_without_registry(tmp_path):
+    conn = create_embedded_connection(str(tmp_path / "db.sqlite"))
+    csv = tmp_path / "a.csv"
+    csv.write_text("a,b\n1,2\n3,4\n")
+    config = utils.UploadCsvConfig(
+        name="t", path=str(csv), columns=[("a", "int"), ("b", "int")], ignore_lines=1
+    )
+    config.upload(conn)
+    # As if the table had been loaded before the registry existed
+    conn.execute(f"DELETE FROM `{utils.LOAD_REGISTRY_TABLE}`")
+    conn.commit()
+
+    config.upload(conn)
+    assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 2
+
+
+def test_recreate_reloads_changed_definition(tmp_path):
+    conn = create_embedded_connection(str(tmp_path / "db.sqlite"))
+    csv = tmp_path / "a.csv"
+    csv.write_text("a,b\n1,2\n3,4\n")
+    columns = [("a", "int"), ("b", "int")]
+    utils.UploadCsvConfig(name="t", path=str(csv), columns=columns, ignore_lines=1).upload(conn)
+
+    config = utils.UploadCsvConfig(
+        name="t", path=str(csv), columns=columns, ignore_lines=1, primary_key="id"
+    )
+    assert config.upload(conn) == [str(csv)]
+    assert conn.execute("SELECT COUNT(*), MAX(id) FROM t").fetchone() == (2, 2)
+    assert config.upload(conn) == []
+
+
+def test_inferred_types_keep_text_that_numbers_would_change():
+    infer = lambda values: utils._infer_type(values, False, 16)
+    assert infer(["1", "22"]).startswith("tinyint")
+    assert infer(["1.5", "-2e3"]).startswith("double")
+    for values in [["007", "12"], ["nan", "1.5"], ["inf"], ["+44"], ["1_000"]]:
+        assert not infer(values).startswith(("tinyint", "double")), values
+
+
+def test_new_files_widen_inferred_types(tmp_path):
+    conn = create_embedded_connection(str(tmp_path / "db.sqlite"))
+    first, second = tmp_path / "a.csv", tmp_path / "b.csv"
+    first.write_text("1,x\n2,y\n")
+    second.write_text("007,a longer value\n")
+    columns = [("a", None), ("b", None)]
+
+    for recreate in [False, True]:
+        config = utils.UploadCsvConfig(
+            name=f"t{int(recreate)}", path=[str(first)], columns=columns, recreate=recreate
+        )
+        config.upload(conn)
+        get_backend(conn).add_index(config.name, ["a"])
+
+        config.path = [str(first), str(second)]
+        loaded = config.upload(conn)
+        assert loaded == ([str(first), str(second)] if recreate else [str(second)])
+        rows = conn.execute(f"SELECT a, b FROM {config.name} ORDER BY b").fetchall()
+        assert rows == [("007", "a longer value"), ("1", "x"), ("2", "y")]
+    assert check_index_exists(conn, "t0", "a")
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist
+
+import fynesse.assess
+
+
+def test_assess_module_is_importable():
+    # An empty fynesse/assess/ package used to shadow assess.py.
+    for name in [
+        "count_pois_near_coordinates",
+        "count_pois_near_coordinates_batched",
+        "get_feature_counts",
+        "iter_distance_blocks",
+        "nearest_neighbours",
+        "distance_threshold_matrix",
+        "get_nearest_locations",
+        "kmeans_features",
+        "kmeans_chunked",
+        "search_n_clusters",
+    ]:
+        assert hasattr(fynesse.assess, name), name
+
+
+def test_distances_match_cdist():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(300, 5))
+    expected = cdist(X, X)
+    # Small blocks so several are used.
+    memory_bytes = 16 * 300 * 7
+
+    indices, distances = fynesse.assess.nearest_neighbours(X, 3, memory_bytes=memory_bytes)
+    np.fill_diagonal(expected, np.inf)
+    assert (indices == np.argsort(expected, axis=1)[:, :3]).all()
+    np.testing.assert_allclose(distances, np.sort(expected, axis=1)[:, :3], atol=1e-4)
+    np.fill_diagonal(expected, 0)
+
+    matrix = fynesse.assess.distance_threshold_matrix(X, 2.0, memory_bytes=memory_bytes)
+    mask = (expected <= 2.0) & ~np.eye(300, dtype=bool)
+    assert (matrix.toarray() > 0).sum() == mask.sum()
+    np.testing.assert_allclose(matrix.toarray()[mask], expected[mask], atol=1e-4)
+
+
+def test_clustering():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(0, 10, (3, 4))
+    X = np.concatenate([c + rng.normal(size=(50, 4)) for c in centers])
+    df = pd.DataFrame(X, columns=list("abcd"))
+    df["location"] = [f"L{i}" for i in range(len(X))]
+
+    # drop_location must not modify or depend on anything but its argument
+    assert list(fynesse.assess.drop_location(df).columns) == list("abcd")
+    assert "location" in df
+
+    for mini_batch in [False, True]:
+        groups = fynesse.assess.kmeans_features(
+            df, 3, mini_batch=mini_batch, random_state=0
+        )
+        assert sorted(len(g) for g in groups.values()) == [50, 50, 50]
+
+    _, labels = fynesse.assess.kmeans_chunked(X, 3, chunk_size=40, random_state=0)
+    assert len(np.unique(labels)) == 3
+
+    scores = fynesse.assess.search_n_clusters(X, [2, 3, 4], n_jobs=1, random_state=0)
+    assert scores.loc[scores["silhouette"].idxmax(), "n_clusters"] == 3